@@ -14,3 +14,16 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'MusicRec_Back.settings')
 
 application = get_asgi_application()
+
+# Load the recommender in the background so the worker can serve requests right away.
+from django.conf import settings  # noqa: E402
+
+if settings.RECOMMENDER_WARMUP:
+    from recommender.services import sasrec  # noqa: E402
+
+    sasrec.warm_up()
+
+# Flush events spooled before a restart now instead of on the first new activity POST.
+from recommender.spool import get_spool  # noqa: E402
+
+get_spool()
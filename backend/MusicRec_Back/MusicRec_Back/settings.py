@@ -175,4 +175,59 @@ SIMPLE_JWT = {
     "ALGORITHM": "HS256",
     "SIGNING_KEY": SECRET_KEY,
     "AUTH_HEADER_TYPES": ("Bearer",),
-}
\ No newline at end of file
+}
+
+# "recommender" is shared by every worker and management command (it lives in the database),
+# so catalog versions and activity stamps bumped in one process are seen by all others.
+# Its table is created by the recommender migrations (or `manage.py createcachetable`).
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "recommender": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "recommender_cache",
+        "TIMEOUT": None,
+        "OPTIONS": {"MAX_ENTRIES": 1000000},
+    },
+}
+# Every activity POST writes a stamp to "recommender", and each DatabaseCache write costs several
+# queries; point it at Redis (atomic writes, no table scans) when one is available.
+if os.getenv("RECOMMENDER_REDIS_URL"):
+    CACHES["recommender"] = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.getenv("RECOMMENDER_REDIS_URL"),
+        "TIMEOUT": None,
+    }
+
+# Recommender serving
+# CACHES alias holding state that must be consistent across processes (catalog version).
+RECOMMENDER_SHARED_CACHE = os.getenv("RECOMMENDER_SHARED_CACHE", "recommender")
+# Start loading the model in a background thread when the WSGI/ASGI application boots.
+RECOMMENDER_WARMUP = os.getenv("RECOMMENDER_WARMUP", "True") == "True"
+RECOMMENDER_BATCH_WINDOW_MS = float(os.getenv("RECOMMENDER_BATCH_WINDOW_MS", "5"))
+RECOMMENDER_MAX_BATCH_SIZE = int(os.getenv("RECOMMENDER_MAX_BATCH_SIZE", "64"))
+# "exact" (torch.topk over the catalog) or "ivf" (approximate, for large catalogs)
+RECOMMENDER_RETRIEVAL = os.getenv("RECOMMENDER_RETRIEVAL", "exact")
+RECOMMENDER_IVF_LISTS = int(os.getenv("RECOMMENDER_IVF_LISTS", "0"))
+RECOMMENDER_IVF_PROBE = int(os.getenv("RECOMMENDER_IVF_PROBE", "8"))
+# Maximum number of events accepted by one POST to the user activity endpoint.
+RECOMMENDER_ACTIVITY_MAX_BATCH = int(os.getenv("RECOMMENDER_ACTIVITY_MAX_BATCH", "500"))
+# Path of a local SQLite spool for write-behind activity logging; empty writes events synchronously.
+RECOMMENDER_ACTIVITY_SPOOL = os.getenv("RECOMMENDER_ACTIVITY_SPOOL", "")
+RECOMMENDER_ACTIVITY_FLUSH_SECONDS = float(os.getenv("RECOMMENDER_ACTIVITY_FLUSH_SECONDS", "1"))
+# Most recent feedback events (likes, skips, ...) applied as score boosts per request.
+RECOMMENDER_FEEDBACK_WINDOW = int(os.getenv("RECOMMENDER_FEEDBACK_WINDOW", "200"))
+# Per-user history cache: "local" (in-process LRU), a CACHES alias shared by workers, or "" to disable.
+RECOMMENDER_HISTORY_CACHE = os.getenv("RECOMMENDER_HISTORY_CACHE", "local")
+RECOMMENDER_HISTORY_CACHE_MB = int(os.getenv("RECOMMENDER_HISTORY_CACHE_MB", "64"))
+RECOMMENDER_HISTORY_CACHE_TTL = int(os.getenv("RECOMMENDER_HISTORY_CACHE_TTL", "300"))
+# Seconds a user's top-k stays cached while they have no new activity; 0 disables the result cache.
+RECOMMENDER_RESULT_CACHE_TTL = int(os.getenv("RECOMMENDER_RESULT_CACHE_TTL", "300"))
+# CACHES alias storing cached top-k lists (keys embed the activity stamp, so a local cache is safe).
+RECOMMENDER_RESULT_CACHE = os.getenv("RECOMMENDER_RESULT_CACHE", "default")
+# CACHES alias of per-user activity stamps; must be shared so any worker's writes invalidate results.
+RECOMMENDER_ACTIVITY_STAMP_CACHE = os.getenv("RECOMMENDER_ACTIVITY_STAMP_CACHE", "recommender")
+# Users whose per-layer attention keys/values are kept for incremental encoding (0 disables).
+# Each state costs up to num_blocks * 2 * maxlen * hidden_units floats (~300 KB).
+RECOMMENDER_STATE_CACHE_USERS = int(os.getenv("RECOMMENDER_STATE_CACHE_USERS", "256"))
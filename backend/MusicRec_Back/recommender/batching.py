@@ -0,0 +1,61 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """Coalesces concurrent calls into batches for a single handler call.
+
+    Requests submitted within ``window_ms`` of the first pending one (or until
+    ``max_batch`` is reached) are passed together to ``handler``, which must
+    return one result per request in the same order.
+    """
+
+    def __init__(self, handler, window_ms=5.0, max_batch=64):
+        self.handler = handler
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def submit(self, request):
+        future = Future()
+        self._queue.put((request, future))
+        self._ensure_worker()
+        return future.result()
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="recommender-batcher", daemon=True)
+                self._worker.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            requests = [request for request, _ in batch]
+            try:
+                results = self.handler(requests)
+            except Exception as exc:
+                for _, future in batch:
+                    future.set_exception(exc)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
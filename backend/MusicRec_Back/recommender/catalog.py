@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+
+from songs.models import Song
+from recommender.constants import ITEM_INDEX_PATH
+
+CATALOG_VERSION_KEY = "recommender:catalog_version"
+
+# item_ids are embedding rows (1-based, 0 is padding) aligned with song_ids and
+# track_ids; item_table lists the track_id of every row, including removed songs.
+CatalogSnapshot = namedtuple(
+    "CatalogSnapshot", ["version", "item_ids", "track_ids", "index", "song_ids", "item_table"]
+)
+
+
+def shared_cache():
+    """The CACHES alias every process reads, so a bump in one is seen by all."""
+    return caches[getattr(settings, "RECOMMENDER_SHARED_CACHE", "default")]
+
+
+def catalog_version():
+    # A missing stamp (never set, or culled) restarts from the clock, never from an old value.
+    version = shared_cache().get(CATALOG_VERSION_KEY)
+    if version is None:
+        shared_cache().add(CATALOG_VERSION_KEY, time.time_ns(), None)
+        version = shared_cache().get(CATALOG_VERSION_KEY)
+    return version
+
+
+def load_item_table(path=ITEM_INDEX_PATH):
+    if not os.path.exists(path):
+        return None
+    return np.load(path, allow_pickle=False)
+
+
+def legacy_item_table(rows):
+    """Table matching weights trained before the item table existed, when row == Song.id."""
+    item_table = np.full(max((song_id for song_id, _ in rows), default=0), "", dtype=object)
+    for song_id, track_id in rows:
+        item_table[song_id - 1] = track_id
+    return item_table.astype(str)
+
+
+def save_item_table(item_table, path=ITEM_INDEX_PATH):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.asarray(item_table, dtype=str))
+    os.replace(tmp_path, path)
+
+
+def extend_item_table(item_table, track_ids):
+    """Append track_ids without a row yet, in order; existing rows never move."""
+    known = set(item_table.tolist())
+    new = [t for t in dict.fromkeys(track_ids) if t and t not in known]
+    if not new:
+        return item_table
+    return np.concatenate([item_table, np.asarray(new, dtype=str)])
+
+
+class CatalogIndex:
+    """Process-wide track_id <-> embedding row lookup over the Song table.
+
+    Rows come from the append-only item table saved with the model weights,
+    so they stay dense and stable however Song primary keys evolve; songs
+    not in it yet are given the next rows, which are carried over to every
+    later rebuild in this process. The index is built once from a
+    single ``values_list`` query and kept as compact aligned arrays. It is
+    rebuilt only after a ``Song`` save/delete signal in this process or when
+    the version stamp in the ``RECOMMENDER_SHARED_CACHE`` alias changes
+    (bumped by other workers and by bulk imports run as separate commands).
+    """
+
+    def __init__(self, path=ITEM_INDEX_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._dirty = True
+        self._snapshot = None
+
+    def invalidate(self):
+        self._dirty = True
+        try:
+            shared_cache().incr(CATALOG_VERSION_KEY)
+        except ValueError:
+            shared_cache().set(CATALOG_VERSION_KEY, time.time_ns(), None)
+
+    def get(self):
+        version = catalog_version()
+        snapshot = self._snapshot
+        if snapshot is not None and not self._dirty and snapshot.version == version:
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or self._dirty or snapshot.version != version:
+                self._dirty = False
+                snapshot = self._build(version)
+                self._snapshot = snapshot
+        return snapshot
+
+    def _build(self, version):
+        rows = list(Song.objects.order_by("id").values_list("id", "track_id"))
+        song_ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+        track_ids = np.array([r[1] for r in rows], dtype=object)
+
+        item_table = load_item_table(self.path)
+        if self._snapshot is not None:
+            # Keep the rows this process already handed out, even for songs deleted since.
+            previous = self._snapshot.item_table
+            item_table = previous if item_table is None else extend_item_table(item_table, previous.tolist())
+        elif item_table is None:
+            item_table = legacy_item_table(rows)
+        item_table = extend_item_table(item_table, track_ids)
+        row_of = {track_id: row for row, track_id in enumerate(item_table.tolist(), 1)}
+        index = {track_id: row_of[track_id] for _, track_id in rows}
+        item_ids = np.fromiter((index[t] for t in track_ids), dtype=np.int64, count=len(rows))
+        return CatalogSnapshot(version, item_ids, track_ids, index, song_ids, item_table)
+
+
+catalog = CatalogIndex()
@@ -0,0 +1,30 @@
+import os
+
+MODEL_PATH = os.path.join(os.path.dirname(__file__), "sasrec/model_weights.pth")
+# Written next to the weights: the tag vocabulary their feature_proj columns belong to.
+MODEL_META_PATH = os.path.join(os.path.dirname(__file__), "sasrec/model_weights.json")
+# Append-only item table: embedding row r belongs to the track_id at position r - 1.
+ITEM_INDEX_PATH = os.path.join(os.path.dirname(__file__), "sasrec/item_index.npy")
+
+# Number of positional embeddings in SASRec: only this many recent events are used.
+SEQUENCE_MAXLEN = 100
+
+ACTIVITY_PLAY = "play"
+ACTIVITY_LIKE = "like"
+ACTIVITY_UNLIKE = "unlike"
+ACTIVITY_ADD_PLAYLIST = "addPlaylist"
+ACTIVITY_REMOVE_PLAYLIST = "removePlaylist"
+ACTIVITY_SKIP = "skip"
+
+SEQUENCE_ACTIVITIES = [ACTIVITY_PLAY, ACTIVITY_LIKE, ACTIVITY_ADD_PLAYLIST]
+POSITIVE_TYPES = [ACTIVITY_LIKE, ACTIVITY_ADD_PLAYLIST]
+NEGATIVE_TYPES = [ACTIVITY_UNLIKE, ACTIVITY_REMOVE_PLAYLIST, ACTIVITY_SKIP]
+
+# Logit boost applied to an item for each feedback event of the given type.
+FEEDBACK_WEIGHTS = {
+    ACTIVITY_LIKE: 1.0,
+    ACTIVITY_ADD_PLAYLIST: 1.0,
+    ACTIVITY_UNLIKE: -1.0,
+    ACTIVITY_REMOVE_PLAYLIST: -1.0,
+    ACTIVITY_SKIP: -1.0,
+}
@@ -0,0 +1,319 @@
+import torch
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+import numpy as np
+from django.conf import settings
+from recommender.sasrec.model import SASRec
+from users.models import CustomUser
+from recommender.models import UserActivity
+from recommender.catalog import catalog, save_item_table
+from recommender.batching import MicroBatcher
+from recommender.retrieval import build_retriever
+from recommender.features import get_tag_features, item_tag_matrix
+from recommender.history import UserHistory, history_cache
+from recommender.results import activity_stamp, result_cache
+from recommender.constants import MODEL_PATH, MODEL_META_PATH, ITEM_INDEX_PATH, SEQUENCE_ACTIVITIES, SEQUENCE_MAXLEN, FEEDBACK_WEIGHTS
+
+logger = logging.getLogger(__name__)
+
+# Retriever over the items of one catalog snapshot; positions index item_tensor and track_ids,
+# and item_positions maps an item row to its position (-1 if the item is not in the index).
+RetrievalIndex = namedtuple("RetrievalIndex", ["snapshot", "retriever", "item_tensor", "track_ids", "item_positions"])
+
+
+def pad_sequences(seqs, dtype=np.int64):
+    """Left-pad sequences with 0 into a (batch, longest) array."""
+    length = max((len(seq) for seq in seqs), default=0)
+    padded = np.zeros((len(seqs), length), dtype=dtype)
+    for row, seq in enumerate(seqs):
+        if len(seq):
+            padded[row, length - len(seq):] = seq
+    return padded
+
+
+class Args:
+    def __init__(self):
+        self.hidden_units = 128
+        self.num_heads = 8
+        self.num_blocks = 3
+        self.dropout_rate = 0.4
+        self.maxlen = SEQUENCE_MAXLEN
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+class SASRecRecommender:
+    def __init__(self):
+        snapshot = catalog.get()
+        if len(snapshot.item_ids) == 0:
+            raise ValueError("No songs in the database.")
+        # Embedding rows this model was built with; later songs are ignored until the next load.
+        self.item_table = snapshot.item_table
+        num_items = len(self.item_table)
+
+        args = Args()
+        self.tag_features = get_tag_features()
+        item_tags = item_tag_matrix(self.tag_features, snapshot.song_ids, snapshot.item_ids, num_items)
+
+        self.model = SASRec(
+            user_num=CustomUser.objects.count(),
+            item_num=num_items,
+            args=args,
+            tag_feature_tensor=item_tags
+        )
+
+        if os.path.exists(MODEL_PATH):
+            print("Loading SASRec model...")
+            added = self.model.load_grown_state_dict(
+                torch.load(MODEL_PATH, map_location=args.device), self.saved_tag_columns()
+            )
+            if added:
+                print(f"Added embedding rows for {added} new songs.")
+        else:
+            print("No saved model. Initializing a new one.")
+            self.save()
+        # Identifies the loaded weights in result cache keys; shared by workers loading the same file.
+        weights = os.stat(MODEL_PATH)
+        self._set_up(snapshot, self.model, args, item_tags, f"{weights.st_mtime_ns:x}-{weights.st_size:x}")
+
+    @classmethod
+    def from_model(cls, model, args, item_tags=None, model_version="in-memory"):
+        """A recommender serving an already built model over the current catalog.
+
+        Nothing is read from or written to MODEL_PATH and no tag artifact is
+        loaded, so save() is unavailable; used by tests and experiments.
+        """
+        recommender = cls.__new__(cls)
+        snapshot = catalog.get()
+        recommender.item_table = snapshot.item_table
+        recommender.tag_features = None
+        recommender._set_up(snapshot, model, args, item_tags, model_version)
+        return recommender
+
+    def _set_up(self, snapshot, model, args, item_tags, model_version):
+        """Serving state shared by every way of building a recommender."""
+        self.model = model
+        self.args = args
+        self.num_items = model.item_num
+        self.item_tags = item_tags
+        self.model_version = model_version
+        self.feedback_weights = getattr(settings, "RECOMMENDER_FEEDBACK_WEIGHTS", FEEDBACK_WEIGHTS)
+
+        self._states = OrderedDict()
+        self._states_lock = threading.Lock()
+        self._max_states = getattr(settings, "RECOMMENDER_STATE_CACHE_USERS", 0)
+
+        self.model.to(args.device)
+        self.model.eval()
+        self._retrieval_lock = threading.Lock()
+        self._retrieval_thread = None
+        self._retrieval = self.build_retrieval(snapshot)
+
+        window_ms = getattr(settings, "RECOMMENDER_BATCH_WINDOW_MS", 0)
+        max_batch = getattr(settings, "RECOMMENDER_MAX_BATCH_SIZE", 64)
+        self._batcher = MicroBatcher(self._score_requests, window_ms, max_batch) if window_ms > 0 else None
+
+    def saved_tag_columns(self):
+        """feature_proj column in the saved weights of each current tag (-1 if new), or None if unknown."""
+        if not os.path.exists(MODEL_META_PATH):
+            return None
+        with open(MODEL_META_PATH, encoding="utf-8") as f:
+            saved = {tag: col for col, tag in enumerate(json.load(f)["tag_vocabulary"])}
+        return [saved.get(tag, -1) for tag in self.tag_features.vocabulary]
+
+    def save(self):
+        torch.save(self.model.state_dict(), MODEL_PATH)
+        save_item_table(self.item_table, ITEM_INDEX_PATH)
+        tmp_path = MODEL_META_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"tag_vocabulary": list(self.tag_features.vocabulary)}, f)
+        os.replace(tmp_path, MODEL_META_PATH)
+
+    def build_retrieval(self, snapshot):
+        known = snapshot.item_ids <= self.num_items
+        item_tensor = torch.from_numpy(snapshot.item_ids[known]).to(self.args.device)
+        item_positions = torch.full((self.num_items + 1,), -1, dtype=torch.long, device=self.args.device)
+        item_positions[item_tensor] = torch.arange(len(item_tensor), device=self.args.device)
+        with torch.no_grad():
+            item_vectors = self.model.item_emb.weight[item_tensor]
+        retriever = build_retriever(
+            getattr(settings, "RECOMMENDER_RETRIEVAL", "exact"),
+            item_vectors,
+            n_lists=getattr(settings, "RECOMMENDER_IVF_LISTS", 0),
+            n_probe=getattr(settings, "RECOMMENDER_IVF_PROBE", 8),
+        )
+        return RetrievalIndex(snapshot, retriever, item_tensor, snapshot.track_ids[known], item_positions)
+
+    def retriever(self, snapshot):
+        """The current RetrievalIndex, rebuilt in the background once snapshot is newer.
+
+        Building an index (k-means for IVF) never runs on a request or
+        batcher thread: until the rebuild is published, requests keep using
+        the previous index, which is one immutable tuple, so positions and
+        track ids always come from the same snapshot.
+        """
+        retrieval = self._retrieval
+        if snapshot.version > retrieval.snapshot.version:
+            with self._retrieval_lock:
+                if self._retrieval_thread is None or not self._retrieval_thread.is_alive():
+                    self._retrieval_thread = threading.Thread(
+                        target=self._publish_retrieval, args=(snapshot,), name="recommender-retrieval", daemon=True
+                    )
+                    self._retrieval_thread.start()
+        return retrieval
+
+    def _publish_retrieval(self, snapshot):
+        try:
+            retrieval = self.build_retrieval(snapshot)
+        except Exception:
+            logger.exception("Failed to rebuild the retrieval index")
+            return
+        if snapshot.version > self._retrieval.snapshot.version:
+            self._retrieval = retrieval
+
+    def user_history(self, user_id, snapshot):
+        """Read the latest ``maxlen`` sequence events and a bounded feedback window.
+
+        Both reads are LIMIT queries on (user, timestamp), so their cost does
+        not grow with the length of the user's history. The sequence is
+        returned oldest first, matching the order the model is trained on.
+        """
+        track_id_map = snapshot.index
+        activities = UserActivity.objects.filter(user_id=user_id).order_by('-timestamp', '-id')
+
+        recent = activities.filter(activity_type__in=SEQUENCE_ACTIVITIES) \
+            .values_list('track_id', flat=True)[:self.args.maxlen]
+        log_seqs = [track_id_map[t] for t in list(recent)[::-1] if t in track_id_map]
+
+        feedback_window = getattr(settings, "RECOMMENDER_FEEDBACK_WINDOW", 200)
+        recent_feedback = activities.filter(activity_type__in=list(self.feedback_weights)) \
+            .values_list('track_id', 'activity_type')[:feedback_window]
+        feedback = [
+            (track_id_map[t], self.feedback_weights[activity_type])
+            for t, activity_type in recent_feedback
+            if t in track_id_map
+        ]
+        return UserHistory(user_id, log_seqs, [f[0] for f in feedback], [f[1] for f in feedback])
+
+    def recommend(self, user_id):
+        snapshot = catalog.get()
+        # Read before the history, so activity logged meanwhile changes the stamp afterwards.
+        stamp = activity_stamp(user_id)
+        key = result_cache.key(user_id, self.model_version, snapshot.version, stamp)
+        cached = result_cache.get(key)
+        if cached is not None:
+            return cached
+
+        history = history_cache.get(user_id, snapshot.version, stamp)
+        if history is None:
+            history = self.user_history(user_id, snapshot)
+            history_cache.put(user_id, snapshot.version, stamp, history)
+
+        history = self.known_history(history)
+        retrieval = self.retriever(snapshot)
+        if not history.sequence:
+            result = []
+        elif self._batcher is not None:
+            # The history is read on the request thread; only the forward pass is coalesced.
+            result = self._batcher.submit((history, retrieval))
+        else:
+            result = self._score_requests([(history, retrieval)])[0]
+        # Results from an index that is still catching up with the catalog are not cached.
+        if retrieval.snapshot.version == snapshot.version:
+            result_cache.set(key, result)
+        return result
+
+    def known_history(self, history):
+        """Drop songs imported after the model was loaded; they have no embedding row yet."""
+        n = self.num_items
+        if all(i <= n for i in history.sequence) and all(i <= n for i in history.feedback):
+            return history
+        feedback = [(i, w) for i, w in zip(history.feedback, history.weights) if i <= n]
+        return UserHistory(
+            history.user_id,
+            [i for i in history.sequence if i <= n],
+            [f[0] for f in feedback],
+            [f[1] for f in feedback],
+        )
+
+    def _score_requests(self, requests):
+        results = [None] * len(requests)
+        groups = {}
+        for i, (_, retrieval) in enumerate(requests):
+            groups.setdefault(id(retrieval), (retrieval, []))[1].append(i)
+
+        for retrieval, rows in groups.values():
+            ranked = self.rank(retrieval, [requests[i][0] for i in rows])
+            for i, track_ids in zip(rows, ranked):
+                results[i] = track_ids
+        return results
+
+    def _cached_state(self, history):
+        """Encoder state for history, reusing or extending the user's cached state if possible."""
+        with self._states_lock:
+            state = self._states.get(history.user_id)
+            if state is not None:
+                self._states.move_to_end(history.user_id)
+        if state is None:
+            return None
+        sequence = tuple(history.sequence)
+        if state.sequence == sequence:
+            return state
+        # Extending only works while the window has not slid: positions are absolute.
+        if sequence[:len(state.sequence)] != state.sequence or len(sequence) > self.args.maxlen:
+            return None
+        state = self.model.extend_state(state, sequence[len(state.sequence):])
+        self._store_state(history.user_id, state)
+        return state
+
+    def _store_state(self, user_id, state):
+        with self._states_lock:
+            self._states[user_id] = state
+            self._states.move_to_end(user_id)
+            while len(self._states) > self._max_states:
+                self._states.popitem(last=False)
+
+    def encode(self, histories):
+        """Final sequence features (batch, hidden) for histories.
+
+        With RECOMMENDER_STATE_CACHE_USERS > 0, per-user attention keys/values
+        are kept so a user whose sequence only grew by appended events is
+        encoded incrementally; everyone else goes through one batched pass.
+        """
+        if not self._max_states:
+            log_tensor = torch.from_numpy(pad_sequences([h.sequence for h in histories])).to(self.args.device)
+            return self.model.log2feats(log_tensor)[:, -1, :]
+
+        feats = [self._cached_state(h) for h in histories]
+        feats = [None if state is None else state.feat for state in feats]
+        missing = [i for i, feat in enumerate(feats) if feat is None]
+        if missing:
+            sequences = [histories[i].sequence for i in missing]
+            log_tensor = torch.from_numpy(pad_sequences(sequences)).to(self.args.device)
+            layer_inputs = []
+            log_feats = self.model.log2feats(log_tensor, layer_inputs)
+            states = self.model.sequence_states(sequences, layer_inputs, log_feats)
+            for i, state in zip(missing, states):
+                self._store_state(histories[i].user_id, state)
+                feats[i] = state.feat
+        return torch.stack(feats)
+
+    def rank(self, retrieval, histories, k=10):
+        device = self.args.device
+
+        # Feedback stays sparse: (positions, weights) in the retriever's item order, with
+        # padding and items missing from the index given weight 0.
+        feedback_tensor = torch.from_numpy(pad_sequences([h.feedback for h in histories])).to(device)
+        weight_tensor = torch.from_numpy(pad_sequences([h.weights for h in histories], np.float32)).to(device)
+        feedback_positions = retrieval.item_positions[feedback_tensor]
+        weight_tensor = weight_tensor * (feedback_positions >= 0)
+        feedback = (feedback_positions.clamp(min=0), weight_tensor)
+
+        with torch.no_grad():
+            final_feats = self.encode(histories)
+            positions = retrieval.retriever.search(final_feats, k, feedback).cpu().numpy()
+
+        # Positions are aligned with the retriever's items, so map them back to track ids.
+        return [retrieval.track_ids[row].tolist() for row in positions]
@@ -0,0 +1,2 @@
+class RecommenderNotReady(Exception):
+    """The recommender model is still loading."""
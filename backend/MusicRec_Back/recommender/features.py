@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import tempfile
+from collections import namedtuple
+from contextlib import contextmanager
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+from songs.models import Song
+
+try:
+    import fcntl
+except ImportError:  # Windows: no writer lock; unique temp files still keep every file whole.
+    fcntl = None
+
+ARTIFACT_DIR = os.path.join(os.path.dirname(__file__), "sasrec", "artifacts", "tag_features")
+GENRE_KEYWORDS = ["rock", "pop", "hip_hop", "jazz", "metal", "classical", "electronic", "indie"]
+GENRE_WEIGHT = 2.0
+
+# matrix: CSR (len(item_ids) x len(vocabulary)), row i holds the tags of Song item_ids[i].
+TagFeatures = namedtuple("TagFeatures", ["matrix", "vocabulary", "item_ids", "catalog_hash"])
+
+
+def tokenize_tags(text):
+    return [tag.strip().lower() for tag in text.split(',') if tag.strip()]
+
+
+def catalog_hash(rows):
+    digest = hashlib.sha1()
+    for song_id, tags in rows:
+        digest.update(f"{song_id}\t{tags or ''}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def build_tag_features(rows, digest=None):
+    """L2-normalised TF-IDF over comma separated tags, with genre tags weighted up."""
+    item_ids = np.array([song_id for song_id, _ in rows], dtype=np.int64)
+    vectorizer = TfidfVectorizer(tokenizer=tokenize_tags, token_pattern=None)
+    matrix = vectorizer.fit_transform([tags or "" for _, tags in rows])
+    matrix = normalize(matrix, norm="l2")
+
+    vocabulary = vectorizer.get_feature_names_out().tolist()
+    scale = np.array([GENRE_WEIGHT if tag in GENRE_KEYWORDS else 1.0 for tag in vocabulary])
+    matrix = (matrix @ sp.diags(scale)).astype(np.float32).tocsr()
+    return TagFeatures(matrix, vocabulary, item_ids, digest or catalog_hash(rows))
+
+
+@contextmanager
+def writer_lock(path=ARTIFACT_DIR):
+    """Exclusive lock on the artifact directory, held while an artifact is rebuilt."""
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, ".lock"), "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _replace_file(target, write):
+    """Write through a uniquely named temp file, then move it over ``target``."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp_path, target)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _read_meta(path):
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_tag_features(features, path=ARTIFACT_DIR):
+    """Write the CSR arrays as plain .npy files so readers can memory-map them.
+
+    Array files are named after the catalog hash and meta.json is replaced
+    last, so a reader never sees a half-written artifact. The files of the
+    artifact being replaced are kept for readers that already read its
+    meta.json; older ones are removed. Concurrent writers should go
+    through get_tag_features(), which serialises rebuilds.
+    """
+    os.makedirs(path, exist_ok=True)
+    prefix = features.catalog_hash[:16]
+    previous = _read_meta(path)
+    arrays = {
+        "data": features.matrix.data,
+        "indices": features.matrix.indices,
+        "indptr": features.matrix.indptr,
+        "item_ids": features.item_ids,
+    }
+    for name, array in arrays.items():
+        # Replace rather than overwrite: other processes may have the old file mapped.
+        _replace_file(os.path.join(path, f"{prefix}.{name}.npy"), lambda f: np.save(f, array))
+
+    meta = {
+        "catalog_hash": features.catalog_hash,
+        "shape": list(features.matrix.shape),
+        "vocabulary": features.vocabulary,
+        "files": {name: f"{prefix}.{name}.npy" for name in arrays},
+    }
+    _replace_file(os.path.join(path, "meta.json"), lambda f: f.write(json.dumps(meta).encode("utf-8")))
+
+    keep = set(meta["files"].values())
+    if previous is not None:
+        keep.update(previous["files"].values())
+    for filename in os.listdir(path):
+        if filename.endswith(".npy") and filename not in keep:
+            os.remove(os.path.join(path, filename))
+
+
+def load_tag_features(path=ARTIFACT_DIR):
+    """The saved artifact, or None if there is none (or it was removed while being read)."""
+    meta = _read_meta(path)
+    if meta is None:
+        return None
+
+    try:
+        arrays = {
+            name: np.load(os.path.join(path, filename), mmap_mode="r")
+            for name, filename in meta["files"].items()
+        }
+    except FileNotFoundError:
+        return None
+    matrix = sp.csr_matrix(
+        (arrays["data"], arrays["indices"], arrays["indptr"]), shape=tuple(meta["shape"]), copy=False
+    )
+    return TagFeatures(matrix, meta["vocabulary"], arrays["item_ids"], meta["catalog_hash"])
+
+
+def item_tag_matrix(features, song_ids, item_ids, num_items):
+    """CSR (num_items x vocabulary) where row r - 1 holds the tags of embedding row r.
+
+    ``song_ids``/``item_ids`` are the aligned catalog arrays; rows of songs
+    that are gone (or not in the artifact) are left empty.
+    """
+    song_ids = np.asarray(song_ids)
+    if len(features.item_ids) == 0:
+        return sp.csr_matrix((num_items, features.matrix.shape[1]), dtype=np.float32)
+    pos = np.minimum(np.searchsorted(features.item_ids, song_ids), len(features.item_ids) - 1)
+    found = features.item_ids[pos] == song_ids
+    selector = sp.csr_matrix(
+        (np.ones(int(found.sum()), dtype=np.float32), (np.asarray(item_ids)[found] - 1, pos[found])),
+        shape=(num_items, len(features.item_ids)),
+    )
+    return (selector @ features.matrix).tocsr()
+
+
+def get_tag_features(path=ARTIFACT_DIR, rebuild=False):
+    """Load the tag feature artifact, refitting it only when the catalog changed.
+
+    Rebuilds hold writer_lock(), and the artifact is checked again once the
+    lock is held: when several workers start after a catalog change, one
+    refits it and the others load its result.
+    """
+    rows = list(Song.objects.order_by("id").values_list("id", "tags"))
+    digest = catalog_hash(rows)
+    if not rebuild:
+        cached = load_tag_features(path)
+        if cached is not None and cached.catalog_hash == digest:
+            return cached
+
+    with writer_lock(path):
+        if not rebuild:
+            cached = load_tag_features(path)
+            if cached is not None and cached.catalog_hash == digest:
+                return cached
+        features = build_tag_features(rows, digest)
+        save_tag_features(features, path)
+    return features
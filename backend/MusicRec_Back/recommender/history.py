@@ -0,0 +1,156 @@
+import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from recommender.catalog import catalog
+from recommender.constants import FEEDBACK_WEIGHTS, SEQUENCE_ACTIVITIES, SEQUENCE_MAXLEN
+
+UserHistory = namedtuple("UserHistory", ["user_id", "sequence", "feedback", "weights"])
+
+CACHE_KEY = "recommender:history:{}"
+
+
+class SequenceCache:
+    """Per-user recent history, kept up to date as activity is logged.
+
+    Each entry holds the last ``maxlen`` sequence item ids and the last
+    ``feedback_window`` feedback events of a user, tagged with the catalog
+    version the ids belong to and the user's activity stamp when it was
+    read. ``UserActivityView`` appends new events to existing entries; a
+    miss, a catalog change or a different stamp (activity logged or
+    flushed by another process) makes the recommender rebuild the entry
+    from the database.
+
+    By default entries live in an in-process LRU capped at ``max_bytes``.
+    Setting ``RECOMMENDER_HISTORY_CACHE`` to a ``CACHES`` alias stores them
+    in that Django cache instead, so several worker processes share them.
+    Entries expire after ``ttl`` seconds to bound the effect of a lost
+    update racing with a rebuild.
+    """
+
+    def __init__(self, backend="local", max_bytes=64 * 1024 * 1024, ttl=300,
+                 maxlen=SEQUENCE_MAXLEN, feedback_window=200, feedback_weights=FEEDBACK_WEIGHTS):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.maxlen = maxlen
+        self.feedback_window = feedback_window
+        self.feedback_weights = feedback_weights
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.backend)
+
+    @staticmethod
+    def _size(entry):
+        history = entry[-1]
+        return sys.getsizeof(history.sequence) + sys.getsizeof(history.feedback) + sys.getsizeof(history.weights)
+
+    def _read(self, user_id):
+        if self.backend != "local":
+            return caches[self.backend].get(CACHE_KEY.format(user_id))
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._evict(user_id)
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[1:]
+
+    def _write(self, user_id, version, stamp, history):
+        if self.backend != "local":
+            caches[self.backend].set(CACHE_KEY.format(user_id), (version, stamp, history), self.ttl)
+            return
+        entry = (time.monotonic() + self.ttl, version, stamp, history)
+        with self._lock:
+            if user_id in self._entries:
+                self._evict(user_id)
+            self._entries[user_id] = entry
+            self._bytes += self._size(entry)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                self._evict(next(iter(self._entries)))
+
+    def _evict(self, user_id):
+        self._bytes -= self._size(self._entries.pop(user_id))
+
+    def get(self, user_id, version, stamp):
+        if not self.enabled:
+            return None
+        cached = self._read(user_id)
+        if cached is None or cached[0] != version or cached[1] != stamp:
+            return None
+        return cached[2]
+
+    def put(self, user_id, version, stamp, history):
+        if self.enabled:
+            self._write(user_id, version, stamp, history)
+
+    def append(self, user_id, events, previous_stamp, stamp):
+        """Fold (track_id, activity_type) events, oldest first, into a cached entry.
+
+        ``previous_stamp`` and ``stamp`` are the user's activity stamps
+        before and after the events were logged. Only an entry that was
+        current at ``previous_stamp`` is extended (and re-tagged with
+        ``stamp``); users without one are left alone, and their next
+        recommendation rebuilds the history from the database.
+        """
+        if not self.enabled:
+            return
+        cached = self._read(user_id)
+        if cached is None:
+            return
+        snapshot = catalog.get()
+        version, cached_stamp, history = cached
+        if version != snapshot.version or cached_stamp != previous_stamp:
+            return
+
+        sequence = list(history.sequence)
+        feedback = list(zip(history.feedback, history.weights))
+        for track_id, activity_type in events:
+            item_id = snapshot.index.get(track_id)
+            if item_id is None:
+                continue
+            if activity_type in SEQUENCE_ACTIVITIES:
+                sequence.append(item_id)
+            if activity_type in self.feedback_weights:
+                # Feedback is kept newest first, like the database read.
+                feedback.insert(0, (item_id, self.feedback_weights[activity_type]))
+        feedback = feedback[:self.feedback_window]
+        self._write(user_id, version, stamp, UserHistory(
+            user_id,
+            sequence[-self.maxlen:],
+            [f[0] for f in feedback],
+            [f[1] for f in feedback],
+        ))
+
+    def discard(self, user_id):
+        """Drop a user's entry so the next recommendation rebuilds it from the database."""
+        if self.backend == "local":
+            with self._lock:
+                if user_id in self._entries:
+                    self._evict(user_id)
+        elif self.backend:
+            caches[self.backend].delete(CACHE_KEY.format(user_id))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+history_cache = SequenceCache(
+    backend=getattr(settings, "RECOMMENDER_HISTORY_CACHE", "local"),
+    max_bytes=getattr(settings, "RECOMMENDER_HISTORY_CACHE_MB", 64) * 1024 * 1024,
+    ttl=getattr(settings, "RECOMMENDER_HISTORY_CACHE_TTL", 300),
+    feedback_window=getattr(settings, "RECOMMENDER_FEEDBACK_WINDOW", 200),
+    feedback_weights=getattr(settings, "RECOMMENDER_FEEDBACK_WEIGHTS", FEEDBACK_WEIGHTS),
+)
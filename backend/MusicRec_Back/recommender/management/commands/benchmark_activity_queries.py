@@ -0,0 +1,110 @@
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from recommender.models import UserActivity
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the hot UserActivity queries (and show their plans), optionally after seeding synthetic rows. "
+        "Seeded rows are rolled back when the run ends unless --keep is passed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=0, help="Synthetic activity rows to insert first")
+        parser.add_argument("--users", type=int, default=10000, help="Users to spread synthetic rows over")
+        parser.add_argument("--tracks", type=int, default=50000, help="Distinct synthetic track ids")
+        parser.add_argument("--repeat", type=int, default=20, help="Timed runs per query")
+        parser.add_argument("--chunk", type=int, default=50000)
+        parser.add_argument(
+            "--keep", action="store_true",
+            help="Commit the seeded rows instead of rolling them back (remove them later with --cleanup)"
+        )
+        parser.add_argument(
+            "--cleanup", action="store_true", help="Delete the synthetic bench_user_* users and their activity, then exit"
+        )
+
+    def handle(self, *args, **options):
+        if options["cleanup"]:
+            deleted, _ = User.objects.filter(username__startswith="bench_user_").delete()
+            self.stdout.write(f"Deleted {deleted} synthetic rows.")
+            return
+
+        # Synthetic rows live in the real activity table, and some are untrained, so
+        # train_sasrec --only-new would learn from them; they only exist for this run.
+        with transaction.atomic():
+            if options["rows"]:
+                self.seed(options["rows"], options["users"], options["tracks"], options["chunk"])
+                if connection.vendor == "postgresql":
+                    with connection.cursor() as cursor:
+                        cursor.execute(f"ANALYZE {UserActivity._meta.db_table}")
+            try:
+                self.run_queries(options["repeat"])
+            finally:
+                if options["rows"] and not options["keep"]:
+                    transaction.set_rollback(True)
+                    self.stdout.write("Rolled back the seeded rows (pass --keep to commit them).")
+
+    def run_queries(self, repeat):
+        user_ids = list(UserActivity.objects.values_list("user_id", flat=True).distinct()[:repeat])
+        if not user_ids:
+            self.stdout.write("No activity rows; pass --rows to seed some.")
+            return
+        self.stdout.write(f"{UserActivity.objects.count()} activity rows, vendor={connection.vendor}")
+
+        queries = {
+            "recommend: user history, newest first": lambda uid: UserActivity.objects
+                .filter(user_id=uid).order_by("-timestamp").values_list("track_id", "activity_type")[:100],
+            "eval: user history, oldest first": lambda uid: UserActivity.objects
+                .filter(user_id=uid).order_by("timestamp").values_list("track_id", "activity_type"),
+            "train --only-new: untrained rows": lambda uid: UserActivity.objects
+                .filter(trained_on=False).order_by("timestamp").values_list("id")[:1000],
+            "eval: play counts per track": lambda uid: UserActivity.objects
+                .filter(activity_type="play").values("track_id").annotate(n=Count("id"))
+                .order_by("-n")[:100],
+        }
+        for name, build in queries.items():
+            plan = build(user_ids[0]).explain()
+            timings = []
+            for uid in user_ids:
+                start = time.perf_counter()
+                list(build(uid))
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            self.stdout.write(
+                f"{name:<40} | median {timings[len(timings) // 2]:8.2f} ms | max {timings[-1]:8.2f} ms"
+            )
+            self.stdout.write("    " + plan.replace("\n", "\n    "))
+
+    def seed(self, rows, num_users, num_tracks, chunk):
+        existing = User.objects.filter(username__startswith="bench_user_").count()
+        User.objects.bulk_create(
+            [User(username=f"bench_user_{i}") for i in range(existing, num_users)], batch_size=chunk
+        )
+        user_ids = list(User.objects.filter(username__startswith="bench_user_").values_list("id", flat=True))
+        types = [choice for choice, _ in UserActivity.ACTIVITY_TYPES]
+        start = timezone.now() - timedelta(days=365)
+
+        for offset in range(0, rows, chunk):
+            UserActivity.objects.bulk_create([
+                UserActivity(
+                    user_id=random.choice(user_ids),
+                    track_id=f"TR{random.randrange(num_tracks):08d}",
+                    activity_type=random.choice(types),
+                    timestamp=start + timedelta(seconds=random.randrange(365 * 86400)),
+                    # Most history has already been trained on; only the tail is new.
+                    trained_on=random.random() > 0.01,
+                )
+                for _ in range(min(chunk, rows - offset))
+            ])
+            self.stdout.write(f"Seeded {min(offset + chunk, rows)}/{rows} rows", ending="\r")
+        self.stdout.write("")
@@ -0,0 +1,75 @@
+import time
+
+import torch
+from django.core.management.base import BaseCommand
+
+from recommender.catalog import catalog
+from recommender.models import UserActivity
+from recommender.retrieval import ExactRetriever, IVFRetriever
+from recommender.engine import pad_sequences
+from recommender.services import sasrec as lazy_sasrec
+
+
+class Command(BaseCommand):
+    help = "Benchmark approximate (IVF) retrieval against exact top-k: recall and latency."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--k", type=int, default=10)
+        parser.add_argument("--queries", type=int, default=1000, help="Max number of user queries")
+        parser.add_argument("--lists", type=int, default=0, help="IVF lists (0 = sqrt(catalog size))")
+        parser.add_argument("--probe", type=int, nargs="+", default=[1, 4, 8, 16])
+        parser.add_argument("--batch_size", type=int, default=256)
+
+    def handle(self, *args, **options):
+        K = options["k"]
+        batch_size = options["batch_size"]
+        sasrec = lazy_sasrec.get(block=True)
+        snapshot = catalog.get()
+        device = sasrec.args.device
+        model = sasrec.model
+        model.eval()
+
+        item_tensor = torch.from_numpy(snapshot.item_ids).to(device)
+        with torch.no_grad():
+            item_vectors = model.item_emb.weight[item_tensor]
+
+        user_ids = list(
+            UserActivity.objects.values_list("user_id", flat=True).distinct()[:options["queries"]]
+        )
+        histories = [sasrec.user_history(uid, snapshot) for uid in user_ids]
+        sequences = [h.sequence for h in histories if h.sequence]
+
+        with torch.no_grad():
+            if sequences:
+                queries = torch.cat([
+                    model.log2feats(torch.from_numpy(pad_sequences(sequences[i:i + batch_size])).to(device))[:, -1, :]
+                    for i in range(0, len(sequences), batch_size)
+                ])
+            else:
+                self.stdout.write("No user sequences found; using catalog item vectors as queries.")
+                picks = torch.randperm(item_vectors.shape[0])[:options["queries"]]
+                queries = item_vectors[picks]
+
+            self.stdout.write(f"Catalog: {item_vectors.shape[0]} items | Queries: {queries.shape[0]} | K={K}")
+
+            exact = ExactRetriever(item_vectors)
+            t0 = time.perf_counter()
+            truth = exact.search(queries, K)
+            exact_ms = (time.perf_counter() - t0) * 1000 / queries.shape[0]
+            self.stdout.write(f"exact          | recall@{K}: 1.0000 | {exact_ms:.3f} ms/query")
+
+            t0 = time.perf_counter()
+            ivf = IVFRetriever(item_vectors, n_lists=options["lists"])
+            build_s = time.perf_counter() - t0
+            self.stdout.write(f"IVF index built with {ivf.n_lists} lists in {build_s:.2f}s")
+
+            for probe in options["probe"]:
+                ivf.n_probe = min(probe, ivf.n_lists)
+                t0 = time.perf_counter()
+                approx = ivf.search(queries, K)
+                ivf_ms = (time.perf_counter() - t0) * 1000 / queries.shape[0]
+                hits = sum(
+                    len(set(a.tolist()) & set(t.tolist())) for a, t in zip(approx, truth)
+                )
+                recall = hits / truth.numel()
+                self.stdout.write(f"ivf probe={ivf.n_probe:<4} | recall@{K}: {recall:.4f} | {ivf_ms:.3f} ms/query")
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from recommender.features import ARTIFACT_DIR, get_tag_features
+
+
+class Command(BaseCommand):
+    help = "Build the shared TF-IDF tag feature artifact used by serving, training and eval."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--force", action="store_true", help="Refit even if the catalog is unchanged")
+
+    def handle(self, *args, **options):
+        features = get_tag_features(rebuild=options["force"])
+        rows, vocab = features.matrix.shape
+        self.stdout.write(
+            f"Tag features for {rows} songs x {vocab} tags "
+            f"(catalog {features.catalog_hash[:12]}) in {ARTIFACT_DIR}"
+        )
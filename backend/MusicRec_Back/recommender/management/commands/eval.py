@@ -1,37 +1,98 @@
+import time
 from django.core.management.base import BaseCommand
-from django.db.models import Count
-from recommender.services import POSITIVE_TYPES, NEGATIVE_TYPES, SEQUENCE_ACTIVITIES
+from recommender.constants import POSITIVE_TYPES, NEGATIVE_TYPES, SEQUENCE_ACTIVITIES
 from recommender.models import UserActivity
-from songs.models import Song
+from recommender.catalog import catalog
+from recommender.engine import pad_sequences
+from recommender.samples import group_sequences
+from recommender.sasrec.ranking import ranking_metrics, ranking_sums, sampled_ranks, target_ranks
 import torch
-import math
-from tqdm import tqdm
 import pandas as pd
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
+import scipy.sparse as sp
 from sklearn.preprocessing import normalize
-from recommender.services import sasrec
-from itertools import combinations
-
-
-def cosine_similarity_np(a, b):
-    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b) + 1e-8)
-
-def personalization_score(all_recs):
-    n = len(all_recs)
+from tqdm import tqdm
+from recommender.services import sasrec as lazy_sasrec
+
+
+def indicator_matrix(positions, n_cols):
+    """Sparse (rows, n_cols) 0/1 matrix with a one at every positions[r, c]."""
+    rows = np.repeat(np.arange(positions.shape[0]), positions.shape[1])
+    data = np.ones(positions.size, dtype=np.float32)
+    return sp.csr_matrix((data, (rows, positions.reshape(-1))), shape=(positions.shape[0], n_cols))
+
+
+def personalization_score(top_positions, n_items, block_size=1024, sample=None, seed=None):
+    """1 - mean pairwise Jaccard overlap of the users' top-k lists, with a 95% half-width.
+
+    Intersections are the sparse product X @ X.T of the user x item
+    indicator matrix, taken ``block_size`` users at a time, so only pairs
+    that overlap are ever materialised. With ``sample``, the score is
+    estimated on that many random users and the half-width is a normal
+    interval over their per-user mean overlaps; otherwise it is 0.
+    """
+    n = len(top_positions)
+    sampled = sample is not None and sample < n
+    if sampled:
+        top_positions = top_positions[np.random.default_rng(seed).choice(n, sample, replace=False)]
+        n = sample
     if n < 2:
-        return 0.0
-    overlaps = 0.0
-    count = 0
-    for i in range(n):
-        for j in range(i+1, n):
-            a, b = all_recs[i], all_recs[j]
-            inter = len(a & b)
-            union = len(a | b)
-            if union:
-                overlaps += inter / union
-                count += 1
-    return float(1 - overlaps/count) if count else 0.0
+        return 0.0, 0.0
+
+    X = indicator_matrix(top_positions, n_items)
+    XT = X.T.tocsr()
+    sizes = np.asarray(X.sum(axis=1)).ravel()
+    overlap = np.zeros(n)
+    for start in range(0, n, block_size):
+        inter = (X[start:start + block_size] @ XT).tocoo()
+        rows = inter.row + start
+        other = rows != inter.col
+        rows, cols, counts = rows[other], inter.col[other], inter.data[other]
+        overlap += np.bincount(rows, weights=counts / (sizes[rows] + sizes[cols] - counts), minlength=n)
+
+    per_user = overlap / (n - 1)
+    half_width = 1.96 * per_user.std(ddof=1) / np.sqrt(n) if sampled else 0.0
+    return float(1 - per_user.mean()), float(half_width)
+
+
+def intra_list_similarity(top_positions, item_tags):
+    """Mean pairwise tag cosine within each row of top_positions.
+
+    ``item_tags`` rows must be L2-normalised. For unit vectors the pairwise
+    dot products sum to (|sum v|^2 - sum |v|^2) / 2, so one sparse product
+    gives every list's total without forming the k x k similarities.
+    """
+    k = top_positions.shape[1]
+    if k < 2:
+        return np.zeros(top_positions.shape[0])
+    summed = indicator_matrix(top_positions, item_tags.shape[0]) @ item_tags
+    norms = np.asarray(item_tags.multiply(item_tags).sum(axis=1)).ravel()
+    pair_sums = (np.asarray(summed.multiply(summed).sum(axis=1)).ravel() - norms[top_positions].sum(axis=1)) / 2
+    return pair_sums / (k * (k - 1) / 2)
+
+
+def feedback_before(events, cutoffs):
+    """(positives, negatives) item lists per user from events before ``cutoffs[user_id]``.
+
+    Events are compared on their ``position`` column (chronological within
+    a user), so feedback on a held-out target, or anything after it, never
+    boosts the target it is ranked against.
+    """
+    before = events[events["position"] < events["user_id"].map(cutoffs)]
+    positives = before[before["activity_type"].isin(POSITIVE_TYPES)].groupby("user_id")["item"].agg(list)
+    negatives = before[before["activity_type"].isin(NEGATIVE_TYPES)].groupby("user_id")["item"].agg(list)
+    return positives, negatives
+
+
+def tag_neighbours(target_positions, item_tags, n):
+    """Positions of the n items most tag-similar to each target (itself excluded) and their cosines."""
+    sims = (item_tags[target_positions] @ item_tags.T).toarray()
+    rows = np.arange(len(target_positions))
+    sims[rows, target_positions] = -np.inf
+    n = min(n, sims.shape[1] - 1)
+    top = np.argpartition(-sims, n - 1, axis=1)[:, :n] if n > 0 else np.zeros((len(rows), 0), dtype=np.int64)
+    return top, sims[rows[:, None], top]
+
 
 class Command(BaseCommand):
     help = """Evaluate SASRec """
@@ -39,146 +100,147 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("--k", type=int, default=10, help="Top-K for evaluation")
         parser.add_argument("--n", type=int, default=50, help="Top-N similar songs to target (based on tags)")
+        parser.add_argument("--batch_size", type=int, default=256, help="Users scored per forward pass")
+        parser.add_argument(
+            "--personalization_sample", type=int, default=None,
+            help="Estimate personalization on this many random users (default: all users)"
+        )
+        parser.add_argument("--seed", type=int, default=None, help="Seed for sampling users and negatives")
+        parser.add_argument(
+            "--ranking", choices=["full", "sampled"], default="full",
+            help="full: rank each held-out item against the whole catalog; "
+                 "sampled: against --negatives unseen items"
+        )
+        parser.add_argument("--negatives", type=int, default=100, help="Negatives per user in sampled ranking")
 
     def handle(self, *args, **options):
         K = options["k"]
         N = options["n"]
-
-        total = 0
-        topn_hits = 0
-        topn_sim_avgs = []
-        recommended_items = set()
-        all_user_recs = []
-        novelty_list = []
-        diversity_list = []
-
-        users = UserActivity.objects.values("user_id") \
-            .annotate(cnt=Count("id")) \
-            .filter(cnt__gte=5)
-
-        track_id_map = {s.track_id: s.id for s in Song.objects.all()}
-        song_ids = list(track_id_map.values())
-        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-        sasrec.model.to(device)
-        sasrec.model.eval()
-
-        self.stdout.write(f"Evaluating SASRec model on {len(users)} users...")
-
-        tag_df = pd.DataFrame(Song.objects.all().values("id", "tags"))
-        tag_df["tags"] = tag_df["tags"].fillna("")
-        vectorizer = TfidfVectorizer(
-            tokenizer=lambda x: [t.strip().lower() for t in x.split(',') if t.strip()],
-            token_pattern=None
+        batch_size = options["batch_size"]
+        timings = {}
+
+        start = time.perf_counter()
+        sasrec = lazy_sasrec.get(block=True)
+        snapshot = catalog.get()
+        model = sasrec.model
+        device = sasrec.args.device
+        model.eval()
+
+        # Candidates are the current songs the loaded model has embedding rows for.
+        item_rows = snapshot.item_ids[snapshot.item_ids <= sasrec.num_items]
+        position_of = np.full(sasrec.num_items + 1, -1, dtype=np.int64)
+        position_of[item_rows] = np.arange(len(item_rows))
+        item_tensor = torch.from_numpy(item_rows).to(device).unsqueeze(0)
+        item_tags = normalize(sasrec.item_tags[item_rows - 1], norm="l2").tocsr()
+        timings["load"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        df = pd.DataFrame.from_records(
+            UserActivity.objects.order_by("user_id", "timestamp", "id")
+            .values_list("user_id", "track_id", "activity_type").iterator(),
+            columns=["user_id", "track_id", "activity_type"],
         )
-        tag_matrix = vectorizer.fit_transform(tag_df["tags"])
-        tag_matrix = normalize(tag_matrix, norm="l2")
-        tag_vectors = {
-            row["id"]: tag_matrix[i].toarray().squeeze()
-            for i, row in tag_df.iterrows()
-        }
-
-        pop_counts = UserActivity.objects \
-            .filter(activity_type__in=SEQUENCE_ACTIVITIES) \
-            .values("track_id") \
-            .annotate(cnt=Count("id"))
-        pop_counter = {}
-        total_inter = 0
-        for rec in pop_counts:
-            tid = rec["track_id"]
-            if tid in track_id_map:
-                nid = track_id_map[tid]
-                cnt = rec["cnt"]
-                pop_counter[nid] = cnt
-                total_inter += cnt
+        user_counts = df["user_id"].value_counts()
+        df = df.assign(item=df["track_id"].map(snapshot.index)).dropna(subset=["item"])
+        df = df.assign(item=df["item"].astype(np.int64))
+        df = df[df["item"] <= sasrec.num_items]
 
+        sequence_events = df[df["activity_type"].isin(SEQUENCE_ACTIVITIES)]
+        pop_counts = np.bincount(sequence_events["item"], minlength=sasrec.num_items + 1)[item_rows]
         eps = 1e-2
-        pop_frac = {
-            nid: (pop_counter.get(nid, 0) + eps) / (total_inter + eps * len(song_ids))
-            for nid in song_ids
-        }
-
-        with torch.no_grad():
-            for u in tqdm(users, desc="Evaluating users"):
-                user_id = u["user_id"]
-                activities = UserActivity.objects \
-                    .filter(user_id=user_id) \
-                    .order_by("timestamp")
-                sequence = [
-                    track_id_map[a.track_id]
-                    for a in activities
-                    if a.activity_type in SEQUENCE_ACTIVITIES and a.track_id in track_id_map
-                ]
-
-                if len(sequence) < 2:
-                    continue
-
-                input_seq = sequence[:-1]
-                target_song = sequence[-1]
-
-                input_tensor = torch.tensor([input_seq], dtype=torch.long).to(device)
-                item_tensor  = torch.tensor([song_ids], dtype=torch.long).to(device)
-                user_tensor  = torch.tensor([user_id], dtype=torch.long).to(device)
-
-                pos_seq = [
-                    track_id_map[a.track_id]
-                    for a in activities
-                    if a.activity_type in POSITIVE_TYPES and a.track_id in track_id_map
-                ]
-                neg_seq = [
-                    track_id_map[a.track_id]
-                    for a in activities
-                    if a.activity_type in NEGATIVE_TYPES and a.track_id in track_id_map
-                ]
-                pos_tensor = torch.tensor([pos_seq], dtype=torch.long).to(device)
-                neg_tensor = torch.tensor([neg_seq], dtype=torch.long).to(device)
-
-                logits = sasrec.model.predict(
-                    user_tensor, input_tensor, item_tensor, pos_tensor, neg_tensor
-                )
-                ranking = logits[0].argsort(descending=True).tolist()
-                top_k = ranking[:K]
-
-                total += 1
-                all_user_recs.append(set(top_k))
-                recommended_items.update(top_k)
-
-                nov = [1 - pop_frac.get(sid, 0.0) for sid in top_k]
-                novelty_list.append(np.mean(nov) if nov else 0.0)
-
-                sims = [
-                    cosine_similarity_np(tag_vectors[i], tag_vectors[j])
-                    for i, j in combinations(top_k, 2)
-                    if i in tag_vectors and j in tag_vectors
-                ]
-                diversity_list.append(1.0 - np.mean(sims) if sims else 0.0)
-
-                all_sims = [
-                    (sid, cosine_similarity_np(tag_vectors[target_song], tag_vectors[sid]))
-                    for sid in song_ids
-                    if sid != target_song and sid in tag_vectors
-                ]
-                top_n_similar_sorted = sorted(all_sims, key=lambda x: x[1], reverse=True)[:N]
-                topn_ids = {sid for sid, _ in top_n_similar_sorted}
-                matched = len(set(top_k) & topn_ids)
-                topn_hits += matched
-                topn_sim_values = [sim for _, sim in top_n_similar_sorted]
-                avg_topn_sim = np.mean(topn_sim_values) if topn_sim_values else 0
-                topn_sim_avgs.append(avg_topn_sim)
+        pop_frac = (pop_counts + eps) / (pop_counts.sum() + eps * len(item_rows))
+
+        df = df[df["user_id"].isin(user_counts[user_counts >= 5].index)]
+        df = df.assign(position=np.arange(len(df)))
+        sequence_events = df[df["activity_type"].isin(SEQUENCE_ACTIVITIES)]
+        # Each user's held-out target is their last sequence event.
+        positives, negatives = feedback_before(df, sequence_events.groupby("user_id")["position"].max())
 
+        items = sequence_events["item"].to_numpy()
+        users, offsets = group_sequences(sequence_events["user_id"].to_numpy(), items)
+        held_out = np.diff(offsets) >= 2
+        users, starts, ends = users[held_out], offsets[:-1][held_out], offsets[1:][held_out] - 1
+        timings["data"] = time.perf_counter() - start
 
+        total = len(users)
         if total == 0:
             self.stdout.write("Not enough data to evaluate.")
             return
+        self.stdout.write(f"Evaluating SASRec model on {total} users...")
 
-        personalization = personalization_score(all_user_recs)
-        novelty = float(np.mean(novelty_list)) if novelty_list else 0.0
-        diversity = float(np.mean(diversity_list)) if diversity_list else 0.0
+        topn_hits = 0
+        topn_sim_sums = 0.0
+        novelty_sum = 0.0
+        diversity_sum = 0.0
+        recommended = np.zeros(len(item_rows), dtype=bool)
+        all_top = []
+        ranking_totals = np.zeros(3)
+        rng = np.random.default_rng(options["seed"])
+        timings["scoring"] = timings["metrics"] = 0.0
+
+        for b in tqdm(range(0, total, batch_size), desc="Evaluating users"):
+            start = time.perf_counter()
+            batch = slice(b, b + batch_size)
+            batch_users = users[batch].tolist()
+            log_seqs = pad_sequences([
+                items[max(s, e - sasrec.args.maxlen):e] for s, e in zip(starts[batch], ends[batch])
+            ])
+            pos_seqs = pad_sequences([positives.get(u, []) for u in batch_users])
+            neg_seqs = pad_sequences([negatives.get(u, []) for u in batch_users])
+            with torch.no_grad():
+                logits = model.predict(
+                    None,
+                    torch.from_numpy(log_seqs).to(device),
+                    item_tensor,
+                    torch.from_numpy(pos_seqs).to(device),
+                    torch.from_numpy(neg_seqs).to(device),
+                )
+                top = torch.topk(logits, min(K, logits.shape[-1])).indices.cpu().numpy()
+                # HR/NDCG/MRR rank the held-out item under the same logits; their boosts only
+                # come from feedback before it, so the target's own like does not leak the label.
+                target_columns = position_of[items[ends[batch]]]
+                if options["ranking"] == "sampled":
+                    seen = [position_of[items[s:e]] for s, e in zip(starts[batch], ends[batch])]
+                    ranks = sampled_ranks(logits, target_columns, options["negatives"], seen, rng)
+                else:
+                    ranks = target_ranks(logits, torch.from_numpy(target_columns).to(logits.device))
+                ranking_totals += ranking_sums(ranks.cpu().numpy(), K)
+            timings["scoring"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            recommended[top.reshape(-1)] = True
+            all_top.append(top)
+            novelty_sum += (1 - pop_frac[top]).mean(axis=1).sum()
+            diversity_sum += (1.0 - intra_list_similarity(top, item_tags)).sum()
+
+            similar, sims = tag_neighbours(target_columns, item_tags, N)
+            is_similar = np.zeros(logits.shape, dtype=bool)
+            rows = np.arange(len(top))[:, None]
+            is_similar[rows, similar] = True
+            topn_hits += int(is_similar[rows, top].sum())
+            if sims.shape[1]:
+                topn_sim_sums += sims.mean(axis=1).sum()
+            timings["metrics"] += time.perf_counter() - start
+
+        ranking = ranking_metrics(ranking_totals, total)
+
+        start = time.perf_counter()
+        personalization, half_width = personalization_score(
+            np.concatenate(all_top), len(item_rows),
+            sample=options["personalization_sample"], seed=options["seed"],
+        )
+        timings["personalization"] = time.perf_counter() - start
 
-        self.stdout.write(f"Coverage: {len(recommended_items) / len(song_ids):.4f}")
+        self.stdout.write(
+            f"HR@{K}: {ranking.hr:.4f} | NDCG@{K}: {ranking.ndcg:.4f} | MRR: {ranking.mrr:.4f} ({options['ranking']})"
+        )
+        self.stdout.write(f"Coverage: {recommended.sum() / len(item_rows):.4f}")
         self.stdout.write(f"Top-{K} in Top-{N} Tag-Similar Songs: {topn_hits / total:.4f}")
-        self.stdout.write(f"Avg Top-{N} Tag-Similarity to Target: {np.mean(topn_sim_avgs):.4f}")
-        self.stdout.write(f"Novelty: {novelty:.4f}")
-        self.stdout.write(f"Personalization: {personalization:.4f}")
-        self.stdout.write(f"Diversity: {diversity:.4f}")
-        self.stdout.write("Evaluation results saved to evaluation_tag_similarity_topn.xlsx")
\ No newline at end of file
+        self.stdout.write(f"Avg Top-{N} Tag-Similarity to Target: {topn_sim_sums / total:.4f}")
+        self.stdout.write(f"Novelty: {novelty_sum / total:.4f}")
+        if options["personalization_sample"] is not None:
+            self.stdout.write(f"Personalization: {personalization:.4f} ± {half_width:.4f}")
+        else:
+            self.stdout.write(f"Personalization: {personalization:.4f}")
+        self.stdout.write(f"Diversity: {diversity_sum / total:.4f}")
+        self.stdout.write("Timing: " + " | ".join(f"{phase} {seconds:.2f}s" for phase, seconds in timings.items()))
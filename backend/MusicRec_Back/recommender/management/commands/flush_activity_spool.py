@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from recommender.spool import get_spool
+
+
+class Command(BaseCommand):
+    help = "Write all events queued in the activity spool to the database."
+
+    def handle(self, *args, **options):
+        spool = get_spool(start=False)
+        if spool is None:
+            self.stdout.write("RECOMMENDER_ACTIVITY_SPOOL is not set; nothing to flush.")
+            return
+        written = spool.flush_all()
+        self.stdout.write(f"Flushed {written} events ({spool.pending()} still pending)")
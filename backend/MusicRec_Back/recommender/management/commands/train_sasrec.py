@@ -1,40 +1,60 @@
 import os
-import random
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler, TensorDataset
 import numpy as np
 import pandas as pd
 from django.core.management.base import BaseCommand
-from django.db.models import Count
 from tqdm import tqdm
-from songs.models import Song
 from recommender.models import UserActivity
-from recommender.services import SASRecRecommender, POSITIVE_TYPES, NEGATIVE_TYPES, SEQUENCE_ACTIVITIES, MODEL_PATH
-from sklearn.feature_extraction.text import TfidfVectorizer
-
-sasrec = SASRecRecommender()
+from recommender.catalog import catalog
+from recommender.samples import build_sequence_samples, build_training_samples
+from recommender.constants import SEQUENCE_ACTIVITIES
+from recommender.engine import pad_sequences
+from recommender.services import sasrec as lazy_sasrec
 
 class SasrecDataset(torch.utils.data.Dataset):
-    def __init__(self, data):
-        self.data = data
+    """Prefix samples; indexing with a list of ids returns a whole collated batch.
+
+    Used with a BatchSampler and ``batch_size=None`` so each DataLoader
+    worker gathers and left-pads full batches with NumPy instead of
+    collating per-sample tensors.
+    """
+
+    def __init__(self, samples, maxlen):
+        self.samples = samples
+        self.maxlen = maxlen
 
     def __len__(self):
-        return len(self.data)
+        return len(self.samples.ends)
 
     def __getitem__(self, idx):
-        return self.data[idx]
+        s = self.samples
+        idx = np.asarray(idx)
+        ends = s.ends[idx]
+        starts = np.maximum(s.starts[idx], ends - self.maxlen)
+        # Left-padded like serving and the sequence-mode windows, so the last column is the latest item.
+        log_seqs = pad_sequences([s.items[start:end] for start, end in zip(starts, ends)])
+
+        return (
+            torch.from_numpy(s.users[idx].astype(np.int64)),
+            torch.from_numpy(log_seqs),
+            torch.from_numpy(s.positives[idx].astype(np.int64)).unsqueeze(1),
+            torch.from_numpy(s.negatives[idx].astype(np.int64)).unsqueeze(1),
+        )
+
+
+def batch_loader(dataset, batch_size, workers, prefetch, pin_memory):
+    sampler = BatchSampler(RandomSampler(dataset), batch_size, drop_last=False)
+    options = {}
+    if workers > 0:
+        options = {"persistent_workers": True, "prefetch_factor": prefetch}
+    return DataLoader(
+        dataset, sampler=sampler, batch_size=None, num_workers=workers, pin_memory=pin_memory, **options
+    )
 
-def collate_fn(batch):
-    uids, log_seqs, pos_list, neg_list = zip(*batch)
-    log_seq_tensors = [torch.tensor(seq, dtype=torch.long) for seq in log_seqs]
-    padded_log_seqs = nn.utils.rnn.pad_sequence(log_seq_tensors, batch_first=True, padding_value=0)
-    pos_tensor = torch.tensor(pos_list, dtype=torch.long).unsqueeze(1)
-    neg_tensor = torch.tensor(neg_list, dtype=torch.long).unsqueeze(1)
-    uid_tensor = torch.tensor(uids, dtype=torch.long)
-    return uid_tensor, padded_log_seqs, pos_tensor, neg_tensor
 
 class Command(BaseCommand):
     help = "Train SASRec with tag similarity loss."
@@ -43,18 +63,32 @@ class Command(BaseCommand):
         parser.add_argument('--epochs', type=int, default=1)
         parser.add_argument('--only-new', action='store_true')
         parser.add_argument('--batch_size', type=int, default=32)
+        parser.add_argument(
+            '--workers', type=int, default=min(4, max((os.cpu_count() or 1) - 1, 0)),
+            help="DataLoader worker processes preparing batches (0 = in the training process)"
+        )
+        parser.add_argument('--prefetch', type=int, default=4, help="Batches prefetched per worker")
+        parser.add_argument(
+            '--mode', choices=['prefix', 'sequence'], default='prefix',
+            help="prefix: one (prefix, next item) pair per sample; "
+                 "sequence: one window of up to maxlen items per sample with a loss at every position"
+        )
 
     def handle(self, *args, **options):
         EPOCHS = options["epochs"]
         only_new = options["only_new"]
         batch_size = options["batch_size"]
+        sequence_mode = options["mode"] == "sequence"
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+        sasrec = lazy_sasrec.get(block=True)
         model = sasrec.model.to(device)
         model.train()
 
-        track_id_map = {s.track_id: s.id for s in Song.objects.all()}
-        song_ids = list(track_id_map.values())
+        snapshot = catalog.get()
+        track_id_map = snapshot.index
+        # Songs given a row after the model was loaded have no embedding yet; they are trained next load.
+        item_ids = snapshot.item_ids[snapshot.item_ids <= sasrec.num_items]
 
         activities_qs = UserActivity.objects.all().order_by("timestamp").values("user_id", "track_id", "activity_type", "timestamp")
         if only_new:
@@ -64,38 +98,29 @@ class Command(BaseCommand):
         user_counts = df['user_id'].value_counts()
         df = df[df['user_id'].isin(user_counts[user_counts >= 5].index)]
         df = df[df['activity_type'].isin(SEQUENCE_ACTIVITIES)]
-        df['numeric'] = df['track_id'].map(lambda t: track_id_map.get(t)).dropna().astype(int)
+        df = df.assign(numeric=df['track_id'].map(track_id_map)).dropna(subset=['numeric'])
+        df = df[df['numeric'] <= sasrec.num_items]
+        df = df.sort_values(['user_id', 'timestamp'], kind='stable')
 
         self.stdout.write("Preparing training and validation data...")
-        train_data, valid_data = [], []
-        grouped = df.groupby("user_id")
-        for uid, group in tqdm(grouped, desc="Preparing training/validation data"):
-            sequence = group.sort_values("timestamp")["numeric"].tolist()
-            if len(sequence) < 2:
-                continue
-            for i in range(1, len(sequence)-1):
-                log_seq = sequence[:i][-sasrec.args.maxlen:]
-                pos = sequence[i]
-                neg = random.choice([sid for sid in song_ids if sid != pos])
-                train_data.append((uid, log_seq, pos, neg))
-            valid_data.append((uid, sequence[:-1][-sasrec.args.maxlen:], sequence[-1]))
-
-        self.stdout.write(f"Prepared {len(train_data)} training samples and {len(valid_data)} validation samples.")
-
-        dataset = SasrecDataset(train_data)
-        loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=0, collate_fn=collate_fn)
-
-        tag_df = pd.DataFrame(list(Song.objects.all().values("id", "tags")))
-        tag_df['tags'] = tag_df['tags'].fillna("")
-        vectorizer = TfidfVectorizer(tokenizer=lambda x: [t.strip() for t in x.split(',') if t.strip()], token_pattern=None)
-        tag_matrix = vectorizer.fit_transform(tag_df['tags']).toarray()
-        tag_vectors = {row['id']: tag_matrix[i] for i, row in tag_df.iterrows()}
-
-        self.stdout.write(f"Loaded tag vectors for {len(tag_vectors)} songs.")
-
-        def get_tag_tensor(ids):
-            tag_array = np.array([tag_vectors[i.item()] for i in ids])
-            return torch.tensor(tag_array, dtype=torch.float).to(device)
+        train_data, valid_data = build_training_samples(
+            df['user_id'].to_numpy(), df['numeric'].to_numpy(dtype=np.int64), item_ids
+        )
+
+        self.stdout.write(f"Prepared {len(train_data.ends)} training samples and {len(valid_data.ends)} validation samples.")
+
+        if sequence_mode:
+            windows = build_sequence_samples(train_data, sasrec.args.maxlen)
+            self.stdout.write(f"Packed them into {len(windows.users)} sequence windows.")
+            dataset = TensorDataset(*(torch.from_numpy(a) for a in windows))
+        else:
+            dataset = SasrecDataset(train_data, sasrec.args.maxlen)
+        loader = batch_loader(
+            dataset, batch_size, options["workers"], options["prefetch"], pin_memory=device.type == "cuda"
+        )
+
+        # Tag rows are gathered on-device from the sparse table the model already holds.
+        get_tag_tensor = model.tag_vectors
 
         def cosine_similarity_tensor(a, b):
             return F.cosine_similarity(a, b).mean()
@@ -114,23 +139,33 @@ class Command(BaseCommand):
 
             model.train()
             for uid_tensor, log_seq_tensor, pos_tensor, neg_tensor in tqdm(loader, desc=f"Epoch {epoch+1}"):
-                uid_tensor = uid_tensor.to(device)
-                log_seq_tensor = log_seq_tensor.to(device)
-                pos_tensor = pos_tensor.to(device)
-                neg_tensor = neg_tensor.to(device)
-
-                pos_logits, neg_logits = model(uid_tensor, log_seq_tensor, pos_tensor, neg_tensor)
+                uid_tensor = uid_tensor.to(device, non_blocking=True)
+                log_seq_tensor = log_seq_tensor.to(device, non_blocking=True)
+                pos_tensor = pos_tensor.to(device, non_blocking=True)
+                neg_tensor = neg_tensor.to(device, non_blocking=True)
+
+                pos_logits, neg_logits, log_feats = model(
+                    uid_tensor, log_seq_tensor, pos_tensor, neg_tensor, return_feats=True
+                )
+                if sequence_mode:
+                    # Every non-padded position is a (context, next item) training pair.
+                    mask = pos_tensor != 0
+                    pos_logits, neg_logits = pos_logits[mask], neg_logits[mask]
+                    anchor = log_feats[mask]
+                    pos_ids, neg_ids = pos_tensor[mask], neg_tensor[mask]
+                else:
+                    anchor = log_feats[:, -1, :]
+                    pos_ids, neg_ids = pos_tensor.squeeze(1), neg_tensor.squeeze(1)
                 bce_loss = criterion(pos_logits, torch.ones_like(pos_logits)) + \
                            criterion(neg_logits, torch.zeros_like(neg_logits))
 
-                anchor = model.log2feats(log_seq_tensor)[:, -1, :]
-                pos_emb = model.item_emb(pos_tensor.squeeze(1))
-                neg_emb = model.item_emb(neg_tensor.squeeze(1))
+                pos_emb = model.item_emb(pos_ids)
+                neg_emb = model.item_emb(neg_ids)
 
                 triplet_loss = F.triplet_margin_loss(anchor, pos_emb, neg_emb, margin=margin, p=2)
 
-                tag_anchor = get_tag_tensor(pos_tensor.squeeze(1))
-                tag_neg = get_tag_tensor(neg_tensor.squeeze(1))
+                tag_anchor = get_tag_tensor(pos_ids)
+                tag_neg = get_tag_tensor(neg_ids)
                 tag_sim_loss = 1 - cosine_similarity_tensor(tag_anchor, tag_neg)
                 tag_sim_scores.append(1 - tag_sim_loss.item())
 
@@ -150,7 +185,7 @@ class Command(BaseCommand):
 
             self.stdout.write(f"Epoch {epoch+1} completed. Loss: {epoch_loss:.4f} | Avg Pos-Neg Tag Cosine: {avg_tag_sim:.4f} | Anchor→Pos: {avg_anchor_pos:.4f} | Anchor→Neg: {avg_anchor_neg:.4f}")
 
-        torch.save(model.state_dict(), MODEL_PATH)
+        sasrec.save()
         self.stdout.write("Model saved.")
 
         if only_new:
@@ -0,0 +1,14 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from recommender.services import sasrec
+
+
+class Command(BaseCommand):
+    help = "Load the SASRec recommender and report how long startup takes."
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        sasrec.get(block=True)
+        self.stdout.write(f"Recommender ready in {time.perf_counter() - start:.2f}s")
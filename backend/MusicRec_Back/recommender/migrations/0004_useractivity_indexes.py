@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 16:07
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recommender', '0003_alter_useractivity_activity_type_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='useractivity',
+            index=models.Index(fields=['user', 'timestamp'], name='activity_user_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='useractivity',
+            index=models.Index(condition=models.Q(('trained_on', False)), fields=['timestamp'], name='activity_untrained_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='useractivity',
+            index=models.Index(fields=['activity_type', 'track_id'], name='activity_type_track_idx'),
+        ),
+    ]
@@ -20,6 +20,20 @@ class UserActivity(models.Model):
     timestamp = models.DateTimeField(default=timezone.now)
     trained_on = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            # Per-user history, newest or oldest first (recommend, eval).
+            models.Index(fields=["user", "timestamp"], name="activity_user_time_idx"),
+            # Only the small untrained tail is indexed (train_sasrec --only-new).
+            models.Index(
+                fields=["timestamp"],
+                name="activity_untrained_idx",
+                condition=models.Q(trained_on=False),
+            ),
+            # Popularity counts per activity type (eval).
+            models.Index(fields=["activity_type", "track_id"], name="activity_type_track_idx"),
+        ]
+
     def __str__(self):
         return f"{self.user.username} - {self.get_activity_type_display()} - {self.timestamp}"
 
@@ -0,0 +1,93 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+ACTIVITY_STAMP_KEY = "recommender:activity:{}"
+RESULT_KEY = "recommender:results:{}:{}:{}:{}"
+
+
+def stamp_cache():
+    """CACHES alias of the activity stamps; it must be shared by every process that logs activity."""
+    return caches[getattr(settings, "RECOMMENDER_ACTIVITY_STAMP_CACHE", "default")]
+
+
+def activity_stamp(user_id):
+    """Current activity stamp of a user, changed by every touch_activity() call.
+
+    A missing stamp (never set, or evicted) is initialised from the clock,
+    so it can never fall back to a value an older cached result was stored under.
+    """
+    key = ACTIVITY_STAMP_KEY.format(user_id)
+    stamp = stamp_cache().get(key)
+    if stamp is None:
+        stamp_cache().add(key, time.time_ns(), None)
+        stamp = stamp_cache().get(key)
+    return stamp
+
+
+def touch_activity(user_id):
+    """Give the user a fresh activity stamp and return it.
+
+    One write of the clock rather than incr(), which most backends
+    implement as a separate get and set: there is no read to race with,
+    and each of two concurrent writers leaves a new stamp.
+    """
+    stamp = time.time_ns()
+    stamp_cache().set(ACTIVITY_STAMP_KEY.format(user_id), stamp, None)
+    return stamp
+
+
+class ResultCache:
+    """Top-k recommendations keyed by (user, model version, catalog version, activity stamp).
+
+    New activity changes the stamp and a new model or catalog changes the
+    version, so stale entries are never read again and simply expire.
+    Stamps live in the shared ``RECOMMENDER_ACTIVITY_STAMP_CACHE`` alias so
+    activity logged by any worker, and every spool flush of it (see
+    ``ActivitySpool.flush``), invalidates results everywhere; the results
+    themselves are stored in ``backend``.
+    """
+
+    def __init__(self, backend="default"):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        return getattr(settings, "RECOMMENDER_RESULT_CACHE_TTL", 300)
+
+    def key(self, user_id, model_version, catalog_version, stamp=None):
+        if stamp is None:
+            stamp = activity_stamp(user_id)
+        return RESULT_KEY.format(user_id, model_version, catalog_version, stamp)
+
+    def get(self, key):
+        if not self.ttl:
+            return None
+        result = caches[self.backend].get(key)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def set(self, key, result):
+        if self.ttl:
+            caches[self.backend].set(key, result, self.ttl)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else None,
+            }
+
+
+result_cache = ResultCache(backend=getattr(settings, "RECOMMENDER_RESULT_CACHE", "default"))
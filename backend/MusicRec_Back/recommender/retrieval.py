@@ -0,0 +1,94 @@
+import math
+
+import torch
+
+
+class ExactRetriever:
+    """Scores every catalog item and keeps the best k with a partial selection.
+
+    ``feedback`` is an optional (positions, weights) pair of (batch, n)
+    tensors: each weight is added to the score of the item at that
+    position, and zero weights (padding) change nothing.
+    """
+
+    def __init__(self, item_vectors):
+        self.item_vectors = item_vectors.contiguous()
+
+    def search(self, queries, k, feedback=None):
+        scores = queries.matmul(self.item_vectors.t())
+        if feedback is not None:
+            positions, weights = feedback
+            scores.scatter_add_(1, positions, weights)
+        k = min(k, scores.shape[-1])
+        return torch.topk(scores, k, dim=-1).indices
+
+
+class IVFRetriever:
+    """Approximate inner-product search over an inverted-file index.
+
+    Item vectors are clustered with k-means into ``n_lists`` lists; a query
+    only scores the items of its ``n_probe`` closest lists, plus any item
+    carrying a feedback boost so liked/skipped songs are still adjusted.
+    Feedback is passed sparse, as for ExactRetriever, so a query never
+    touches the whole catalog. Queries whose probed lists hold fewer than
+    k items fall back to exact scoring.
+    """
+
+    def __init__(self, item_vectors, n_lists=0, n_probe=8, n_iter=10, seed=0):
+        self.item_vectors = item_vectors.contiguous()
+        num_items = self.item_vectors.shape[0]
+        self.n_lists = max(1, min(n_lists or int(math.sqrt(num_items)), num_items))
+        self.n_probe = min(n_probe, self.n_lists)
+
+        generator = torch.Generator().manual_seed(seed)
+        self.centroids, assignment = self._kmeans(self.item_vectors, self.n_lists, n_iter, generator)
+        self.list_items = torch.argsort(assignment)
+        counts = torch.bincount(assignment, minlength=self.n_lists)
+        self.list_offsets = torch.cat([counts.new_zeros(1), counts.cumsum(0)]).tolist()
+
+    @staticmethod
+    def _kmeans(vectors, n_lists, n_iter, generator):
+        init = torch.randperm(vectors.shape[0], generator=generator)[:n_lists].to(vectors.device)
+        centroids = vectors[init].clone()
+        for _ in range(n_iter + 1):
+            # argmin ||v - c||^2 == argmax (v.c - ||c||^2 / 2)
+            assignment = (vectors.matmul(centroids.t()) - 0.5 * (centroids ** 2).sum(dim=1)).argmax(dim=1)
+            counts = torch.bincount(assignment, minlength=n_lists)
+            sums = torch.zeros_like(centroids).index_add_(0, assignment, vectors)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled].unsqueeze(1).to(vectors.dtype)
+        return centroids, assignment
+
+    def _candidates(self, lists):
+        return torch.cat([self.list_items[self.list_offsets[l]:self.list_offsets[l + 1]] for l in lists])
+
+    def search(self, queries, k, feedback=None):
+        k = min(k, self.item_vectors.shape[0])
+        probes = torch.topk(queries.matmul(self.centroids.t()), self.n_probe, dim=-1).indices.tolist()
+
+        results = []
+        for row, lists in enumerate(probes):
+            candidates = self._candidates(lists)
+            if feedback is not None:
+                boosted = feedback[1][row] != 0
+                positions, weights = feedback[0][row][boosted], feedback[1][row][boosted]
+                # inverse maps every (probed + boosted) entry to its column among the unique candidates.
+                candidates, inverse = torch.unique(torch.cat([candidates, positions]), return_inverse=True)
+            if candidates.numel() < k:
+                exact = ExactRetriever(self.item_vectors)
+                row_feedback = None if feedback is None else (feedback[0][row:row + 1], feedback[1][row:row + 1])
+                results.append(exact.search(queries[row:row + 1], k, row_feedback)[0])
+                continue
+            scores = self.item_vectors[candidates].matmul(queries[row])
+            if feedback is not None:
+                scores.index_add_(0, inverse[len(inverse) - len(positions):], weights)
+            results.append(candidates[torch.topk(scores, k).indices])
+        return torch.stack(results)
+
+
+def build_retriever(mode, item_vectors, n_lists=0, n_probe=8):
+    if mode == "exact":
+        return ExactRetriever(item_vectors)
+    if mode == "ivf":
+        return IVFRetriever(item_vectors, n_lists=n_lists, n_probe=n_probe)
+    raise ValueError(f"Unknown retrieval mode: {mode}")
@@ -0,0 +1,102 @@
+from collections import namedtuple
+
+import numpy as np
+
+# Every user's sequence lives in one flat ``items`` array; sample j is the
+# prefix items[max(starts[j], ends[j] - maxlen):ends[j]] with target
+# items[ends[j]], so no prefix is ever copied.
+TrainingSamples = namedtuple("TrainingSamples", ["users", "items", "starts", "ends", "positives", "negatives"])
+# Sequence-level rows: inputs[r, c] is followed by positives[r, c]; all (rows, maxlen), left-padded with 0.
+SequenceSamples = namedtuple("SequenceSamples", ["users", "inputs", "positives", "negatives"])
+# One held-out sample per user: the full sequence minus its last item.
+ValidationSamples = namedtuple("ValidationSamples", ["users", "items", "starts", "ends", "targets"])
+
+
+def group_sequences(user_ids, item_ids):
+    """Split (user, item) arrays sorted by user, then time, into per-user runs.
+
+    Returns the distinct users and CSR-style offsets into ``item_ids``.
+    """
+    user_ids = np.asarray(user_ids)
+    if len(user_ids) == 0:
+        return user_ids, np.zeros(1, dtype=np.int64)
+    boundaries = np.flatnonzero(user_ids[1:] != user_ids[:-1]) + 1
+    starts = np.concatenate([[0], boundaries])
+    offsets = np.concatenate([starts, [len(user_ids)]]).astype(np.int64)
+    return user_ids[starts], offsets
+
+
+def sample_negatives(positives, candidates, rng):
+    """Draw one candidate per positive, redrawing (vectorised) wherever it hits the positive."""
+    candidates = np.asarray(candidates)
+    if len(positives) == 0:
+        return np.zeros(0, dtype=candidates.dtype)
+    if len(np.unique(candidates)) < 2:
+        raise ValueError("Negative sampling needs at least two candidate items.")
+    negatives = candidates[rng.integers(len(candidates), size=len(positives))]
+    clash = negatives == positives
+    while clash.any():
+        negatives[clash] = candidates[rng.integers(len(candidates), size=int(clash.sum()))]
+        clash = negatives == positives
+    return negatives
+
+
+def build_training_samples(user_ids, item_ids, candidates, seed=None):
+    """Next-item samples for every position but the first and the held-out last one.
+
+    ``user_ids``/``item_ids`` must be sorted by user, then timestamp.
+    """
+    items = np.asarray(item_ids, dtype=np.int64)
+    users, offsets = group_sequences(user_ids, items)
+    lengths = np.diff(offsets)
+
+    # A user of length L yields targets at positions 1 .. L-2.
+    per_user = np.maximum(lengths - 2, 0)
+    first = np.cumsum(per_user) - per_user
+    sample_user = np.repeat(np.arange(len(users)), per_user)
+    ends = offsets[sample_user] + np.arange(per_user.sum()) - first[sample_user] + 1
+
+    positives = items[ends]
+    negatives = sample_negatives(positives, candidates, np.random.default_rng(seed))
+    train = TrainingSamples(users[sample_user], items, offsets[sample_user], ends, positives, negatives)
+
+    held_out = lengths >= 2
+    valid = ValidationSamples(
+        users[held_out], items, offsets[:-1][held_out], offsets[1:][held_out] - 1, items[offsets[1:][held_out] - 1]
+    )
+    return train, valid
+
+
+def build_sequence_samples(samples, maxlen):
+    """Pack next-item samples into left-padded windows of up to ``maxlen`` targets.
+
+    Every target of ``samples`` lands in exactly one window (with the same
+    negative), so a loss over all non-padded positions supervises the same
+    pairs as the per-prefix samples. Users with more than ``maxlen`` targets
+    are split into consecutive windows counted from their latest target;
+    the earliest positions of each window see less context than the
+    corresponding prefix would.
+    """
+    ends = samples.ends
+    if len(ends) == 0:
+        empty = np.zeros((0, maxlen), dtype=np.int64)
+        return SequenceSamples(np.zeros(0, dtype=np.int64), empty, empty, empty)
+
+    # Samples are grouped by user with increasing ends; rank each from its user's last target.
+    last = np.flatnonzero(np.append(samples.starts[1:] != samples.starts[:-1], True))
+    user_last = np.repeat(ends[last], np.diff(np.concatenate([[-1], last])))
+    rank = user_last - ends
+    window = rank // maxlen
+    column = maxlen - 1 - rank % maxlen
+
+    keys = np.stack([samples.starts, window], axis=1)
+    _, first, row = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    row = row.reshape(-1)
+    shape = (len(first), maxlen)
+    inputs = np.zeros(shape, dtype=np.int64)
+    positives = np.zeros(shape, dtype=np.int64)
+    negatives = np.zeros(shape, dtype=np.int64)
+    inputs[row, column] = samples.items[ends - 1]
+    positives[row, column] = samples.positives
+    negatives[row, column] = samples.negatives
+    return SequenceSamples(samples.users[first], inputs, positives, negatives)
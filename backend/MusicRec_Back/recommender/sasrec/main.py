@@ -26,6 +26,7 @@ parser.add_argument('--l2_emb', default=0.0, type=float)
 parser.add_argument('--device', default='cuda', type=str)
 parser.add_argument('--inference_only', default=False, type=str2bool)
 parser.add_argument('--state_dict_path', default=None, type=str)
+parser.add_argument('--eval_negatives', default=100, type=int)  # 0 = rank the full catalog
 
 args = parser.parse_args()
 if not os.path.isdir(args.dataset + '_' + args.train_dir):
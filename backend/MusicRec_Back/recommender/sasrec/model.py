@@ -1,6 +1,12 @@
 import torch
 import numpy as np
 import torch.nn as nn
+import torch.nn.functional as F
+from collections import namedtuple
+
+# Encoder state of one unpadded sequence: per-layer attention keys/values
+# (each (1, len, hidden)) and the final feature of its last position.
+SequenceState = namedtuple("SequenceState", ["sequence", "keys", "values", "feat"])
 
 class PointWiseFeedForward(nn.Module):
     def __init__(self, hidden_units, dropout_rate):
@@ -41,11 +47,24 @@ class SASRec(nn.Module):
         self.feature_proj = nn.Linear(tag_feature_tensor.shape[1], args.hidden_units)
         self.alpha = nn.Parameter(torch.tensor(0.1))
 
-        tag_feature_tensor = tag_feature_tensor.to(self.dev)
-        self.audio_features = torch.cat([
-            torch.zeros((1, tag_feature_tensor.shape[1]), device=self.dev),
-            tag_feature_tensor
-        ], dim=0)
+        # Tag features are kept sparse (CSR) and projected with a weighted
+        # embedding-bag sum, so no dense items x vocabulary matrix is stored.
+        # Accepts a scipy.sparse CSR matrix or a dense tensor.
+        if isinstance(tag_feature_tensor, torch.Tensor):
+            rows, cols = tag_feature_tensor.nonzero(as_tuple=True)
+            values = tag_feature_tensor[rows, cols]
+            counts = torch.bincount(rows, minlength=tag_feature_tensor.shape[0])
+            indptr = torch.cat([counts.new_zeros(1), counts.cumsum(0)])
+        else:
+            indptr = torch.tensor(np.asarray(tag_feature_tensor.indptr), dtype=torch.long)
+            cols = torch.tensor(np.asarray(tag_feature_tensor.indices), dtype=torch.long)
+            values = torch.tensor(np.asarray(tag_feature_tensor.data), dtype=torch.float)
+        # Row 0 is the padding item and has no tags.
+        self.tag_offsets = torch.cat([indptr.new_zeros(1), indptr]).to(self.dev)
+        self.tag_indices = cols.to(self.dev)
+        self.tag_weights = values.to(self.dev, torch.float)
+        self.num_tags = tag_feature_tensor.shape[1]
+        self._fused_items = None
 
         self.attention_layernorms = nn.ModuleList()
         self.attention_layers = nn.ModuleList()
@@ -59,26 +78,130 @@ class SASRec(nn.Module):
             self.forward_layernorms.append(nn.LayerNorm(args.hidden_units, eps=1e-8))
             self.forward_layers.append(PointWiseFeedForward(args.hidden_units, args.dropout_rate))
 
-    def log2feats(self, log_seqs):
-        item_ids = log_seqs.to(self.dev)
-        item_embs = self.item_emb(item_ids)
-        audio_feats = self.audio_features[item_ids]
-        audio_proj = self.feature_proj(audio_feats)
+    def train(self, mode=True):
+        if mode:
+            self.clear_inference_cache()
+        return super().train(mode)
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        self.clear_inference_cache()
+        return super().load_state_dict(state_dict, *args, **kwargs)
+
+    def load_grown_state_dict(self, state_dict, tag_columns=None):
+        """Load weights saved for an older catalog into this (possibly larger) model.
+
+        item_emb rows present in the checkpoint are kept; rows of songs added
+        since keep their fresh initialisation. ``tag_columns[j]`` is the
+        checkpoint's feature_proj column of tag j, or -1 for a new tag; by
+        default the columns are assumed unchanged. Returns the number of
+        newly initialised item rows.
+        """
+        state = dict(state_dict)
+        item_emb = self.item_emb.weight.detach().clone()
+        saved = state["item_emb.weight"].to(item_emb.device)
+        rows = min(len(saved), len(item_emb))
+        item_emb[:rows] = saved[:rows]
+        state["item_emb.weight"] = item_emb
+
+        if tag_columns is not None:
+            proj = self.feature_proj.weight.detach().clone()
+            tag_columns = torch.as_tensor(tag_columns, dtype=torch.long, device=proj.device)
+            kept = tag_columns >= 0
+            proj[:, kept] = state["feature_proj.weight"].to(proj.device)[:, tag_columns[kept]]
+            state["feature_proj.weight"] = proj
+
+        self.load_state_dict(state)
+        return len(item_emb) - rows
+
+    def _apply(self, fn, *args, **kwargs):
+        self.clear_inference_cache()
+        return super()._apply(fn, *args, **kwargs)
+
+    def clear_inference_cache(self):
+        self._fused_items = None
+
+    def _tag_entries(self, item_ids):
+        """Flat positions of every stored tag of item_ids plus per-item bag offsets."""
+        starts = self.tag_offsets[item_ids]
+        lengths = self.tag_offsets[item_ids + 1] - starts
+        bag_offsets = torch.cumsum(lengths, 0) - lengths
+        entries = torch.arange(int(lengths.sum()), device=self.dev)
+        entries += torch.repeat_interleave(starts - bag_offsets, lengths)
+        return entries, bag_offsets, lengths
+
+    def project_tags(self, item_ids):
+        """feature_proj(tag vector) for each id, computed from the sparse tag rows."""
+        flat_ids = item_ids.reshape(-1)
+        entries, bag_offsets, _ = self._tag_entries(flat_ids)
+        proj = F.embedding_bag(
+            self.tag_indices[entries],
+            self.feature_proj.weight.t(),
+            bag_offsets,
+            mode="sum",
+            per_sample_weights=self.tag_weights[entries],
+        ) + self.feature_proj.bias
+        return proj.reshape(*item_ids.shape, -1)
 
-        fused_feats = self.alpha * item_embs + (1 - self.alpha) * audio_proj
-        fused_feats *= self.hidden_units ** 0.5
+    def tag_vectors(self, item_ids):
+        """Dense (len(item_ids), num_tags) tag rows for a 1-D tensor of ids."""
+        entries, _, lengths = self._tag_entries(item_ids)
+        rows = torch.repeat_interleave(torch.arange(len(item_ids), device=self.dev), lengths)
+        dense = torch.zeros((len(item_ids), self.num_tags), device=self.dev)
+        dense[rows, self.tag_indices[entries]] = self.tag_weights[entries]
+        return dense
 
-        log_seqs_np = log_seqs.cpu().numpy() if isinstance(log_seqs, torch.Tensor) else log_seqs
-        poss = np.tile(np.arange(1, log_seqs_np.shape[1] + 1), [log_seqs_np.shape[0], 1])
-        poss *= (log_seqs_np != 0)
-        poss = np.minimum(poss, self.pos_emb.num_embeddings - 1)
-        fused_feats += self.pos_emb(torch.tensor(poss, dtype=torch.long, device=self.dev))
-        fused_feats = self.emb_dropout(fused_feats)
+    def fused_item_table(self):
+        """alpha * item_emb + (1 - alpha) * feature_proj(tags) for every item row.
+
+        Cached while the model is in eval mode with autograd disabled; the
+        cache is dropped on train(), load_state_dict() and device moves.
+        """
+        if self.training or torch.is_grad_enabled():
+            return None
+        if self._fused_items is None:
+            all_items = torch.arange(self.item_num + 1, device=self.dev)
+            audio_proj = self.project_tags(all_items)
+            self._fused_items = (self.alpha * self.item_emb.weight + (1 - self.alpha) * audio_proj).contiguous()
+        return self._fused_items
+
+    def embed(self, item_ids, poss):
+        fused_items = self.fused_item_table()
+        if fused_items is not None:
+            fused_feats = fused_items[item_ids]
+        else:
+            item_embs = self.item_emb(item_ids)
+            audio_proj = self.project_tags(item_ids)
+            fused_feats = self.alpha * item_embs + (1 - self.alpha) * audio_proj
+        fused_feats = fused_feats * self.hidden_units ** 0.5
+        fused_feats += self.pos_emb(poss)
+        return self.emb_dropout(fused_feats)
+
+    def log2feats(self, log_seqs, layer_inputs=None):
+        """Encode left-padded sequences into (batch, len, hidden) features.
+
+        If ``layer_inputs`` is a list, the input of every attention block is
+        appended to it (see sequence_states()).
+        """
+        item_ids = torch.as_tensor(log_seqs, dtype=torch.long, device=self.dev)
+
+        # Count positions from the first real item so left-padded batches encode
+        # every sequence exactly as they would be encoded on their own.
+        timeline_mask = item_ids == 0
+        poss = torch.cumsum(~timeline_mask, dim=1) * ~timeline_mask
+        poss = poss.clamp(max=self.pos_emb.num_embeddings - 1)
+        fused_feats = self.embed(item_ids, poss)
 
         tl = fused_feats.shape[1]
         attention_mask = ~torch.tril(torch.ones((tl, tl), dtype=torch.bool, device=self.dev))
+        if timeline_mask.any():
+            # Hide padded keys; the diagonal stays open so padded queries never see an empty row.
+            eye = torch.eye(tl, dtype=torch.bool, device=self.dev)
+            attention_mask = attention_mask | (timeline_mask[:, None, :] & ~eye)
+            attention_mask = attention_mask.repeat_interleave(self.attention_layers[0].num_heads, dim=0)
 
         for i in range(len(self.attention_layers)):
+            if layer_inputs is not None:
+                layer_inputs.append(fused_feats)
             fused_feats = torch.transpose(fused_feats, 0, 1)
             Q = self.attention_layernorms[i](fused_feats)
             mha_outputs, _ = self.attention_layers[i](Q, fused_feats, fused_feats, attn_mask=attention_mask)
@@ -89,31 +212,138 @@ class SASRec(nn.Module):
 
         return self.last_layernorm(fused_feats)
 
-    def forward(self, user_ids, log_seqs, pos_seqs, neg_seqs):
+    def _key_value(self, layer, inputs):
+        hidden = self.hidden_units
+        weight, bias = layer.in_proj_weight, layer.in_proj_bias
+        keys = F.linear(inputs, weight[hidden:2 * hidden], bias[hidden:2 * hidden])
+        values = F.linear(inputs, weight[2 * hidden:], bias[2 * hidden:])
+        return keys, values
+
+    def sequence_states(self, sequences, layer_inputs, final_feats):
+        """Per-sequence SequenceState from a log2feats(..., layer_inputs) pass.
+
+        Left padding is sliced off: padded keys are masked out of every real
+        position, so the states match encoding each sequence on its own.
+        Every slice is cloned so a cached state does not keep the whole
+        batch's tensors alive.
+        """
+        projected = [self._key_value(layer, inputs) for layer, inputs in zip(self.attention_layers, layer_inputs)]
+        tl = final_feats.shape[1]
+        states = []
+        for row, sequence in enumerate(sequences):
+            start = tl - len(sequence)
+            states.append(SequenceState(
+                tuple(sequence),
+                [keys[row:row + 1, start:].clone() for keys, _ in projected],
+                [values[row:row + 1, start:].clone() for _, values in projected],
+                final_feats[row, -1].clone(),
+            ))
+        return states
+
+    def extend_state(self, state, new_items):
+        """Encode only the items appended to ``state.sequence``, reusing cached keys/values.
+
+        Equivalent to log2feats() on the whole sequence in eval mode, as long
+        as the extended sequence still fits in the positional embeddings.
+        """
+        start = len(state.sequence)
+        n = len(new_items)
+        if start + n > self.pos_emb.num_embeddings - 1:
+            raise ValueError("Extended sequence is longer than maxlen; re-encode it from scratch.")
+        item_ids = torch.as_tensor([new_items], dtype=torch.long, device=self.dev)
+        poss = torch.arange(start + 1, start + n + 1, device=self.dev).unsqueeze(0)
+        fused_feats = self.embed(item_ids, poss)
+
+        # New query j sits at absolute position start + j and sees every key up to it.
+        allowed = torch.arange(start + n, device=self.dev) <= torch.arange(start, start + n, device=self.dev)[:, None]
+        keys, values = [], []
+        for i, layer in enumerate(self.attention_layers):
+            heads = layer.num_heads
+            new_keys, new_values = self._key_value(layer, fused_feats)
+            layer_keys = torch.cat([state.keys[i], new_keys], dim=1)
+            layer_values = torch.cat([state.values[i], new_values], dim=1)
+            keys.append(layer_keys)
+            values.append(layer_values)
+
+            Q = self.attention_layernorms[i](fused_feats)
+            q = F.linear(Q, layer.in_proj_weight[:self.hidden_units], layer.in_proj_bias[:self.hidden_units])
+            split = lambda t: t.reshape(1, t.shape[1], heads, -1).transpose(1, 2)
+            attended = F.scaled_dot_product_attention(split(q), split(layer_keys), split(layer_values), attn_mask=allowed)
+            mha_outputs = layer.out_proj(attended.transpose(1, 2).reshape(1, n, self.hidden_units))
+            fused_feats = Q + mha_outputs
+            fused_feats = self.forward_layernorms[i](fused_feats)
+            fused_feats = self.forward_layers[i](fused_feats)
+
+        feat = self.last_layernorm(fused_feats)[0, -1]
+        return SequenceState(state.sequence + tuple(new_items), keys, values, feat)
+
+    def forward(self, user_ids, log_seqs, pos_seqs, neg_seqs, return_feats=False):
+        """Positive/negative logits; with return_feats=True also the (batch, len, hidden) features
+        they were computed from, so auxiliary losses can share the same encoder pass."""
         log_feats = self.log2feats(log_seqs)
         pos_embs = self.item_emb(pos_seqs.to(self.dev))
         neg_embs = self.item_emb(neg_seqs.to(self.dev))
         pos_logits = (log_feats * pos_embs).sum(dim=-1)
         neg_logits = (log_feats * neg_embs).sum(dim=-1)
+        if return_feats:
+            return pos_logits, neg_logits, log_feats
         return pos_logits, neg_logits
 
-    def predict(self, user_ids, log_seqs, item_indices, pos_seqs=None, neg_seqs=None):
+    def feedback_boost(self, batch_size, pos_seqs=None, neg_seqs=None,
+                       feedback_seqs=None, feedback_weights=None, pos_weight=1.0, neg_weight=1.0):
+        """Per-item logit adjustments of shape (batch, item_num + 1), or None.
+
+        Feedback ids are scatter-added with their weights, so repeated events
+        accumulate and padding ids (0) contribute nothing.
+        """
+        ids, weights = [], []
+        if pos_seqs is not None:
+            pos_seqs = torch.as_tensor(pos_seqs, dtype=torch.long, device=self.dev)
+            ids.append(pos_seqs)
+            weights.append(torch.full(pos_seqs.shape, pos_weight, device=self.dev))
+        if neg_seqs is not None:
+            neg_seqs = torch.as_tensor(neg_seqs, dtype=torch.long, device=self.dev)
+            ids.append(neg_seqs)
+            weights.append(torch.full(neg_seqs.shape, -neg_weight, device=self.dev))
+        if feedback_seqs is not None:
+            ids.append(torch.as_tensor(feedback_seqs, dtype=torch.long, device=self.dev))
+            weights.append(torch.as_tensor(feedback_weights, dtype=torch.float, device=self.dev))
+
+        ids = [i.reshape(batch_size, -1) for i in ids]
+        weights = [w.reshape(batch_size, -1) for w in weights]
+        if not ids or sum(i.shape[1] for i in ids) == 0:
+            return None
+
+        ids = torch.cat(ids, dim=1)
+        weights = torch.cat(weights, dim=1) * (ids != 0)
+        boost = torch.zeros((batch_size, self.item_num + 1), device=self.dev)
+        return boost.scatter_add_(1, ids, weights)
+
+    def predict(self, user_ids, log_seqs, item_indices=None, pos_seqs=None, neg_seqs=None,
+                feedback_seqs=None, feedback_weights=None, pos_weight=1.0, neg_weight=1.0):
+        """Score candidate items for each sequence.
+
+        With ``item_indices=None`` every embedding row is scored with a single
+        matmul and the result has shape (batch, item_num + 1), row id == column.
+        Otherwise item_indices may be a single shared candidate row for the
+        whole batch or one row per sequence.
+        """
         log_feats = self.log2feats(log_seqs)
         final_feat = log_feats[:, -1, :]
 
-        item_embs = self.item_emb(item_indices)
-        logits = item_embs.matmul(final_feat.unsqueeze(-1)).squeeze(-1)
+        if item_indices is None:
+            logits = final_feat.matmul(self.item_emb.weight.t())
+        else:
+            item_embs = self.item_emb(item_indices)
+            logits = item_embs.matmul(final_feat.unsqueeze(-1)).squeeze(-1)
 
-        if pos_seqs is not None:
-            for i, pos_ids in enumerate(pos_seqs):
-                for pid in pos_ids:
-                    mask = (item_indices[i] == pid)
-                    logits[i][mask] += 1.0
-
-        if neg_seqs is not None:
-            for i, neg_ids in enumerate(neg_seqs):
-                for nid in neg_ids:
-                    mask = (item_indices[i] == nid)
-                    logits[i][mask] -= 1.0
+        boost = self.feedback_boost(
+            logits.shape[0], pos_seqs, neg_seqs, feedback_seqs, feedback_weights, pos_weight, neg_weight
+        )
+        if boost is not None:
+            if item_indices is None:
+                logits += boost
+            else:
+                logits += boost.gather(1, item_indices.expand(logits.shape[0], -1))
 
-        return logits
\ No newline at end of file
+        return logits
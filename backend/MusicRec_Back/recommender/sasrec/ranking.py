@@ -0,0 +1,125 @@
+import numpy as np
+import torch
+from collections import namedtuple
+
+# Means over the evaluated users; ranks are 0-based (0 = target scored first).
+RankingMetrics = namedtuple("RankingMetrics", ["hr", "ndcg", "mrr", "users"])
+
+
+def left_pad(sequences, maxlen):
+    """Last ``maxlen`` ids of each sequence, left-padded with 0 into a (batch, maxlen) array."""
+    padded = np.zeros((len(sequences), maxlen), dtype=np.int64)
+    for row, seq in enumerate(sequences):
+        seq = seq[-maxlen:]
+        if len(seq):
+            padded[row, maxlen - len(seq):] = seq
+    return padded
+
+
+def target_ranks(scores, target_columns):
+    """Number of candidates scoring strictly higher than each row's target column.
+
+    One comparison against the target score replaces a double argsort.
+    """
+    target_scores = scores.gather(1, target_columns.unsqueeze(1))
+    return (scores > target_scores).sum(dim=1)
+
+
+def ranking_sums(ranks, k):
+    """(hits@k, ndcg@k, reciprocal rank) summed over ``ranks``."""
+    ranks = np.asarray(ranks, dtype=np.float64)
+    hit = ranks < k
+    return np.array([hit.sum(), (hit / np.log2(ranks + 2)).sum(), (1.0 / (ranks + 1)).sum()])
+
+
+def ranking_metrics(sums, users):
+    """RankingMetrics from ranking_sums() accumulated over ``users`` targets."""
+    if users == 0:
+        return RankingMetrics(0.0, 0.0, 0.0, 0)
+    hr, ndcg, mrr = np.asarray(sums, dtype=np.float64) / users
+    return RankingMetrics(float(hr), float(ndcg), float(mrr), users)
+
+
+def sampled_ranks(scores, target_columns, num_negatives, seen_columns, rng):
+    """Ranks of the targets among ``num_negatives`` sampled columns of already computed scores.
+
+    Same protocol as sample_candidates(), but reuses a full (batch, columns)
+    score matrix instead of scoring the sampled candidates again.
+    """
+    columns = sample_candidates(
+        np.asarray(target_columns), np.arange(scores.shape[1]), num_negatives, seen_columns, rng
+    )
+    sampled = scores.gather(1, torch.from_numpy(columns).to(scores.device))
+    return target_ranks(sampled, torch.zeros(len(columns), dtype=torch.long, device=scores.device))
+
+
+def sample_candidates(targets, items, num_negatives, seen, rng):
+    """(batch, 1 + num_negatives) candidate ids with the target in column 0.
+
+    Negatives are drawn uniformly from ``items`` and redrawn (vectorised)
+    wherever they hit the target or one of the user's ``seen`` ids.
+    """
+    items = np.asarray(items, dtype=np.int64)
+    batch = len(targets)
+    base = int(items.max()) + 1
+    # Membership is tested on row * base + id keys against one sorted array.
+    excluded = np.unique(np.concatenate(
+        [np.arange(batch, dtype=np.int64) * base + np.asarray(targets, dtype=np.int64)]
+        + [row * base + np.asarray(list(s), dtype=np.int64) for row, s in enumerate(seen) if len(s)]
+    ))
+    blocked = np.bincount(excluded[np.isin(excluded % base, items)] // base, minlength=batch)
+    if num_negatives and (blocked >= len(np.unique(items))).any():
+        raise ValueError("A user has seen every item; no negatives left to sample.")
+
+    rows = np.repeat(np.arange(batch, dtype=np.int64), num_negatives).reshape(batch, num_negatives)
+    negatives = items[rng.integers(len(items), size=(batch, num_negatives))]
+
+    def clashes(values):
+        keys = rows * base + values
+        pos = np.minimum(np.searchsorted(excluded, keys), len(excluded) - 1)
+        return excluded[pos] == keys
+
+    clash = clashes(negatives)
+    while clash.any():
+        negatives[clash] = items[rng.integers(len(items), size=int(clash.sum()))]
+        clash = clashes(negatives)
+    return np.concatenate([np.asarray(targets, dtype=np.int64)[:, None], negatives], axis=1)
+
+
+def evaluate_ranking(model, sequences, targets, items, maxlen, k=10, num_negatives=None,
+                     seen=None, batch_size=256, seed=None):
+    """HR@k, NDCG@k and MRR of each target given the sequence before it.
+
+    By default every id in ``items`` is ranked (full catalog); ``targets``
+    must be among them. With ``num_negatives``, each target is ranked
+    against that many ids sampled from ``items`` excluding the user's
+    ``seen`` ids, the protocol of the original SASRec evaluation.
+    """
+    items = np.asarray(items, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    dev = model.dev
+    sums = np.zeros(3)
+
+    if num_negatives is None:
+        column_of = np.full(int(items.max()) + 1, -1, dtype=np.int64)
+        column_of[items] = np.arange(len(items))
+        all_items = torch.from_numpy(items).to(dev).unsqueeze(0)
+
+    with torch.no_grad():
+        for start in range(0, len(targets), batch_size):
+            batch = slice(start, start + batch_size)
+            log_seqs = torch.from_numpy(left_pad(sequences[batch], maxlen)).to(dev)
+            if num_negatives is None:
+                candidates = all_items
+                columns = torch.from_numpy(column_of[targets[batch]]).to(dev)
+            else:
+                batch_seen = seen[batch] if seen is not None else [()] * len(targets[batch])
+                candidates = torch.from_numpy(
+                    sample_candidates(targets[batch], items, num_negatives, batch_seen, rng)
+                ).to(dev)
+                columns = torch.zeros(candidates.shape[0], dtype=torch.long, device=dev)
+            scores = model.predict(None, log_seqs, candidates)
+            sums += ranking_sums(target_ranks(scores, columns).cpu().numpy(), k)
+
+    return ranking_metrics(sums, len(targets))
@@ -1,10 +1,8 @@
-import sys
-import copy
-import torch
 import random
 import numpy as np
 from collections import defaultdict
 from multiprocessing import Process, Queue
+from ranking import evaluate_ranking
 
 def build_index(dataset_name):
 
@@ -123,97 +121,36 @@ def data_partition(fname):
             user_test[user].append(User[user][-1])
     return [user_train, user_valid, user_test, usernum, itemnum]
 
-# TODO: merge evaluate functions for test and val set
-# evaluate on test set
-def evaluate(model, dataset, args):
-    [train, valid, test, usernum, itemnum] = copy.deepcopy(dataset)
-
-    NDCG = 0.0
-    HT = 0.0
-    valid_user = 0.0
+def _evaluate_split(model, dataset, args, split):
+    [train, valid, test, usernum, itemnum] = dataset
+    # Sampled 100-negative protocol by default; --eval_negatives 0 ranks the full catalog.
+    negatives = getattr(args, 'eval_negatives', 100) or None
 
     if usernum>10000:
         users = random.sample(range(1, usernum + 1), 10000)
     else:
         users = range(1, usernum + 1)
-    for u in users:
 
-        if len(train[u]) < 1 or len(test[u]) < 1: continue
-
-        seq = np.zeros([args.maxlen], dtype=np.int32)
-        idx = args.maxlen - 1
-        seq[idx] = valid[u][0]
-        idx -= 1
-        for i in reversed(train[u]):
-            seq[idx] = i
-            idx -= 1
-            if idx == -1: break
-        rated = set(train[u])
-        rated.add(0)
-        item_idx = [test[u][0]]
-        for _ in range(100):
-            t = np.random.randint(1, itemnum + 1)
-            while t in rated: t = np.random.randint(1, itemnum + 1)
-            item_idx.append(t)
-
-        predictions = -model.predict(*[np.array(l) for l in [[u], [seq], item_idx]])
-        predictions = predictions[0] # - for 1st argsort DESC
-
-        rank = predictions.argsort().argsort()[0].item()
+    sequences, targets, seen = [], [], []
+    for u in users:
+        if len(train[u]) < 1 or len(split[u]) < 1: continue
+        history = train[u] + valid[u] if split is test else train[u]
+        sequences.append(history)
+        targets.append(split[u][0])
+        seen.append(train[u])
 
-        valid_user += 1
+    metrics = evaluate_ranking(
+        model, sequences, targets, np.arange(1, itemnum + 1), args.maxlen,
+        k=10, num_negatives=negatives, seen=seen
+    )
+    return metrics.ndcg, metrics.hr
 
-        if rank < 10:
-            NDCG += 1 / np.log2(rank + 2)
-            HT += 1
-        if valid_user % 100 == 0:
-            print('.', end="")
-            sys.stdout.flush()
 
-    return NDCG / valid_user, HT / valid_user
+# evaluate on test set
+def evaluate(model, dataset, args):
+    return _evaluate_split(model, dataset, args, dataset[2])
 
 
 # evaluate on val set
 def evaluate_valid(model, dataset, args):
-    [train, valid, test, usernum, itemnum] = copy.deepcopy(dataset)
-
-    NDCG = 0.0
-    valid_user = 0.0
-    HT = 0.0
-    if usernum>10000:
-        users = random.sample(range(1, usernum + 1), 10000)
-    else:
-        users = range(1, usernum + 1)
-    for u in users:
-        if len(train[u]) < 1 or len(valid[u]) < 1: continue
-
-        seq = np.zeros([args.maxlen], dtype=np.int32)
-        idx = args.maxlen - 1
-        for i in reversed(train[u]):
-            seq[idx] = i
-            idx -= 1
-            if idx == -1: break
-
-        rated = set(train[u])
-        rated.add(0)
-        item_idx = [valid[u][0]]
-        for _ in range(100):
-            t = np.random.randint(1, itemnum + 1)
-            while t in rated: t = np.random.randint(1, itemnum + 1)
-            item_idx.append(t)
-
-        predictions = -model.predict(*[np.array(l) for l in [[u], [seq], item_idx]])
-        predictions = predictions[0]
-
-        rank = predictions.argsort().argsort()[0].item()
-
-        valid_user += 1
-
-        if rank < 10:
-            NDCG += 1 / np.log2(rank + 2)
-            HT += 1
-        if valid_user % 100 == 0:
-            print('.', end="")
-            sys.stdout.flush()
-
-    return NDCG / valid_user, HT / valid_user
+    return _evaluate_split(model, dataset, args, dataset[1])
@@ -0,0 +1,10 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from songs.models import Song
+from recommender.catalog import catalog
+
+
+@receiver([post_save, post_delete], sender=Song)
+def invalidate_catalog(sender, **kwargs):
+    catalog.invalidate()
@@ -0,0 +1,200 @@
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from recommender.history import history_cache
+from recommender.models import UserActivity
+from recommender.results import touch_activity
+
+logger = logging.getLogger(__name__)
+
+
+class ActivitySpool:
+    """Local write-behind queue for user activity events.
+
+    Events are appended to a SQLite database in WAL mode next to the
+    server, which is a single fsync-light insert, and a background flusher
+    moves them into ``UserActivity`` with ``bulk_create``. Rows are only
+    removed from the spool after the bulk insert has committed, so events
+    survive database outages and process restarts (delivery is at least
+    once: a crash between the two steps can replay a batch).
+
+    Several processes may flush the same spool (web workers and the
+    ``flush_activity_spool`` command): each flush first claims its rows in
+    one ``BEGIN IMMEDIATE`` transaction, so no row is inserted twice.
+    Claims of a flusher that died are released after ``claim_timeout``.
+
+    After each committed batch the flusher gives its users a new activity
+    stamp and drops their history-cache entries, so results computed
+    before the rows reached the database are not served any longer.
+    """
+
+    def __init__(self, path, flush_interval=1.0, flush_batch=1000, claim_timeout=300.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.claim_timeout = claim_timeout
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._stop = threading.Event()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " user_id INTEGER NOT NULL,"
+            " track_id TEXT,"
+            " activity_type TEXT NOT NULL,"
+            " timestamp TEXT NOT NULL)"
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(events)")}
+        if "claim" not in columns:
+            self._conn.execute("ALTER TABLE events ADD COLUMN claim TEXT")
+            self._conn.execute("ALTER TABLE events ADD COLUMN claimed_at REAL")
+
+    def append(self, user_id, events):
+        """Queue (track_id, activity_type) pairs; timestamps are taken now, not at flush time."""
+        now = timezone.now().isoformat()
+        rows = [(user_id, track_id, activity_type, now) for track_id, activity_type in events]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO events (user_id, track_id, activity_type, timestamp) VALUES (?, ?, ?, ?)", rows
+            )
+
+    def pending(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+    def _claim(self):
+        """Atomically mark up to ``flush_batch`` unclaimed rows as ours and return them."""
+        token = uuid.uuid4().hex
+        now = timezone.now().timestamp()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "UPDATE events SET claim = NULL WHERE claim IS NOT NULL AND claimed_at < ?",
+                    (now - self.claim_timeout,),
+                )
+                self._conn.execute(
+                    "UPDATE events SET claim = ?, claimed_at = ? WHERE id IN"
+                    " (SELECT id FROM events WHERE claim IS NULL ORDER BY id LIMIT ?)",
+                    (token, now, self.flush_batch),
+                )
+                rows = self._conn.execute(
+                    "SELECT id, user_id, track_id, activity_type, timestamp FROM events"
+                    " WHERE claim = ? ORDER BY id",
+                    (token,),
+                ).fetchall()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return token, rows
+
+    def flush(self):
+        """Move up to ``flush_batch`` queued events into the database; returns how many were written."""
+        token, rows = self._claim()
+        if not rows:
+            return 0
+
+        try:
+            with transaction.atomic():
+                UserActivity.objects.bulk_create([
+                    UserActivity(
+                        user_id=user_id,
+                        track_id=track_id,
+                        activity_type=activity_type,
+                        timestamp=datetime.fromisoformat(stamp),
+                    )
+                    for _, user_id, track_id, activity_type, stamp in rows
+                ])
+        except BaseException:
+            with self._lock:
+                self._conn.execute("UPDATE events SET claim = NULL WHERE claim = ?", (token,))
+            raise
+
+        with self._lock:
+            self._conn.execute("DELETE FROM events WHERE claim = ?", (token,))
+        self._invalidate({row[1] for row in rows})
+        return len(rows)
+
+    def _invalidate(self, user_ids):
+        try:
+            for user_id in user_ids:
+                history_cache.discard(user_id)
+                touch_activity(user_id)
+        except Exception:
+            # The batch is committed; the entries expire on their own TTLs.
+            logger.exception("Failed to invalidate recommender caches after a spool flush")
+
+    def flush_all(self):
+        total = 0
+        while True:
+            written = self.flush()
+            total += written
+            if written < self.flush_batch:
+                return total
+
+    def start(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        self._stop.clear()
+        self._flusher = threading.Thread(target=self._run, name="activity-spool-flusher", daemon=True)
+        self._flusher.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                written = self.flush_all()
+            except Exception:
+                # Keep the events spooled and retry on the next tick.
+                logger.exception("Failed to flush the activity spool")
+                written = 0
+            finally:
+                connection.close()
+            if not written:
+                self._stop.wait(self.flush_interval)
+
+
+_spool = None
+_spool_lock = threading.Lock()
+
+
+def get_spool(start=True):
+    """Return the process-wide spool, or None when write-behind is disabled.
+
+    With ``start``, its background flusher is running on return; the
+    WSGI/ASGI entry points call this at boot so events left in the spool
+    by a previous process are written without waiting for new activity.
+    """
+    global _spool
+    path = getattr(settings, "RECOMMENDER_ACTIVITY_SPOOL", "")
+    if not path:
+        return None
+    with _spool_lock:
+        if _spool is None or _spool.path != path:
+            _spool = ActivitySpool(
+                path,
+                flush_interval=getattr(settings, "RECOMMENDER_ACTIVITY_FLUSH_SECONDS", 1.0),
+            )
+        if start:
+            _spool.start()
+    return _spool
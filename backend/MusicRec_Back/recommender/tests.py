@@ -1,11 +1,7 @@
 import sys
-import types
 
-_dummy_services = types.ModuleType("recommender.services")
-_dummy_services.sasrec = types.SimpleNamespace(recommend=lambda user_id: [])
-sys.modules["recommender.services"] = _dummy_services
-
-from recommender.services import sasrec as sasrec_module
+# Importing the services module is cheap: the recommender only loads on warm_up().
+from recommender.services import LazyRecommender, sasrec as sasrec_module
 
 import types as _types
 from django.urls import path
@@ -19,12 +15,33 @@ _test_urls.urlpatterns = [
 sys.modules["test_urls"] = _test_urls
 
 import json
+import threading
+from datetime import timedelta
 import pytest
+import torch
+import numpy as np
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 from rest_framework.test import APIClient
 from rest_framework import status
 from songs.models import Song
 from recommender.models import UserActivity
+from recommender.catalog import CatalogIndex, catalog, save_item_table, shared_cache
+from recommender.exceptions import RecommenderNotReady
+from recommender.batching import MicroBatcher
+from recommender.sasrec.model import SASRec
+from recommender.retrieval import ExactRetriever, IVFRetriever
+from recommender.features import get_tag_features, item_tag_matrix
+from recommender.spool import ActivitySpool, get_spool
+from recommender.engine import SASRecRecommender
+from recommender.history import SequenceCache, UserHistory, history_cache
+from recommender.results import ResultCache, activity_stamp, stamp_cache, touch_activity
+from recommender.samples import build_sequence_samples, build_training_samples
+from recommender.sasrec.ranking import evaluate_ranking, sample_candidates, sampled_ranks, target_ranks
+from recommender.management.commands.train_sasrec import SasrecDataset
+from recommender.management.commands.eval import (
+    feedback_before, intra_list_similarity, personalization_score, tag_neighbours,
+)
 
 pytestmark = pytest.mark.django_db
 User = get_user_model()
@@ -34,6 +51,13 @@ User = get_user_model()
 def urls(settings):
     settings.ROOT_URLCONF = "test_urls"
 
+@pytest.fixture(autouse=True)
+def item_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(catalog, "path", str(tmp_path / "item_index.npy"))
+    monkeypatch.setattr(catalog, "_snapshot", None)
+    catalog.invalidate()
+    return catalog.path
+
 @pytest.fixture
 def api_client():
     return APIClient()
@@ -87,6 +111,71 @@ class TestUserActivityAndRecommendations:
         types = {a.activity_type for a in acts}
         assert types == {"play", "like"}
 
+    def test_useractivity_rejects_invalid_events(self, auth_client, settings, django_assert_num_queries):
+        # Only the activity write is counted; stamps go to the in-memory cache here.
+        settings.RECOMMENDER_ACTIVITY_STAMP_CACHE = "default"
+        payload = {"activity_logs": [
+            {"type": "play", "songId": "s1"},
+            {"type": "dance", "songId": "s2"},
+            "skip",
+            {"type": "skip", "songId": "s3"},
+        ]}
+        with django_assert_num_queries(3):  # savepoint, bulk insert, release
+            resp = auth_client.post(
+                self.useractivity_url,
+                data=json.dumps(payload),
+                content_type="application/json"
+            )
+        assert resp.status_code == status.HTTP_201_CREATED
+        assert [r["index"] for r in resp.json()["rejected"]] == [1, 2]
+        acts = UserActivity.objects.filter(user=auth_client.handler._force_user)
+        assert sorted(acts.values_list("track_id", flat=True)) == ["s1", "s3"]
+
+    def test_useractivity_batch_limit(self, auth_client, settings):
+        settings.RECOMMENDER_ACTIVITY_MAX_BATCH = 2
+        payload = {"activity_logs": [{"type": "play", "songId": f"s{i}"} for i in range(3)]}
+        resp = auth_client.post(
+            self.useractivity_url,
+            data=json.dumps(payload),
+            content_type="application/json"
+        )
+        assert resp.status_code == status.HTTP_400_BAD_REQUEST
+        assert not UserActivity.objects.exists()
+
+    def test_useractivity_write_behind(self, auth_client, settings, tmp_path):
+        settings.RECOMMENDER_ACTIVITY_SPOOL = str(tmp_path / "spool.sqlite3")
+        spool = get_spool(start=False)
+        payload = {"activity_logs": [{"type": "play", "songId": "s1"}, {"type": "skip", "songId": "s2"}]}
+        resp = auth_client.post(
+            self.useractivity_url,
+            data=json.dumps(payload),
+            content_type="application/json"
+        )
+        assert resp.status_code == status.HTTP_202_ACCEPTED
+        assert not UserActivity.objects.exists()
+        assert spool.pending() == 2
+
+        assert spool.flush_all() == 2
+        assert spool.pending() == 0
+        acts = UserActivity.objects.filter(user=auth_client.handler._force_user)
+        assert sorted(acts.values_list("activity_type", flat=True)) == ["play", "skip"]
+
+    def test_spooled_activity_survives_a_stamp_cache_outage(self, auth_client, settings, tmp_path, monkeypatch):
+        settings.RECOMMENDER_ACTIVITY_SPOOL = str(tmp_path / "spool.sqlite3")
+        spool = get_spool(start=False)
+
+        def unavailable(*args, **kwargs):
+            raise ConnectionError("cache unavailable")
+
+        monkeypatch.setattr(stamp_cache(), "set", unavailable)
+        resp = auth_client.post(
+            self.useractivity_url,
+            data=json.dumps({"activity_logs": [{"type": "play", "songId": "s1"}]}),
+            content_type="application/json"
+        )
+        assert resp.status_code == status.HTTP_202_ACCEPTED
+        assert spool.pending() == 1
+
     def test_recommend_requires_auth(self, api_client):
         resp = api_client.get(self.recommend_url)
         assert resp.status_code == status.HTTP_401_UNAUTHORIZED
@@ -97,6 +186,15 @@ class TestUserActivityAndRecommendations:
         assert resp.status_code == status.HTTP_200_OK
         assert resp.json().get("recommendations") == []
 
+    def test_recommend_while_warming_up(self, auth_client, monkeypatch):
+        def not_ready(uid):
+            raise RecommenderNotReady()
+
+        monkeypatch.setattr(sasrec_module, 'recommend', not_ready)
+        resp = auth_client.get(self.recommend_url)
+        assert resp.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+        assert resp["Retry-After"] == "5"
+
     def test_recommend_with_songs(self, auth_client, db, monkeypatch):
         s1 = Song.objects.create(
             track_id="x1", name="X", artist="A",
@@ -119,3 +217,636 @@ class TestUserActivityAndRecommendations:
         assert resp.status_code == status.HTTP_200_OK
         recs = resp.json().get("recommendations")
         assert [song['track_id'] for song in recs] == ["x2", "x1"]
+
+
+class TestLazyRecommender:
+    def test_warm_up_loads_in_the_background(self, monkeypatch):
+        release = threading.Event()
+
+        class StubRecommender:
+            def __init__(self):
+                release.wait(5)
+
+            def recommend(self, user_id):
+                return [f"t{user_id}"]
+
+        monkeypatch.setattr("recommender.engine.SASRecRecommender", StubRecommender)
+        lazy = LazyRecommender()
+        lazy.warm_up()
+        assert not lazy.ready and lazy.load_seconds is None
+        with pytest.raises(RecommenderNotReady):
+            lazy.recommend(1)
+
+        release.set()
+        lazy._thread.join(5)
+        assert lazy.ready and lazy.load_seconds >= 0
+        assert lazy.recommend(1) == ["t1"]
+
+    def test_load_errors_are_raised_to_blocking_callers(self, monkeypatch):
+        attempts = []
+
+        class BrokenRecommender:
+            def __init__(self):
+                attempts.append(1)
+                raise ValueError("No songs in the database.")
+
+        monkeypatch.setattr("recommender.engine.SASRecRecommender", BrokenRecommender)
+        lazy = LazyRecommender()
+        with pytest.raises(ValueError, match="No songs"):
+            lazy.get(block=True)
+        assert not lazy.ready and isinstance(lazy.error, ValueError)
+
+        # A later call retries the load instead of caching the failure forever.
+        with pytest.raises(ValueError):
+            lazy.get(block=True)
+        assert len(attempts) == 2
+
+
+def make_song(track_id, tags=""):
+    return Song.objects.create(
+        track_id=track_id, name=track_id, artist="A",
+        spotify_preview_url="u", spotify_id=track_id, tags=tags,
+        year=2000, duration_ms=0, danceability=0.0, energy=0.0,
+        key=0.0, loudness=0.0, mode=0, speechiness=0.0,
+        acousticness=0.0, instrumentalness=0.0, liveness=0.0,
+        valence=0.0, tempo=0.0, time_signature=0.0
+    )
+
+
+class TestCatalogIndex:
+    def test_catalog_tracks_song_changes(self):
+        s1 = make_song("c1")
+        s2 = make_song("c2")
+        snapshot = catalog.get()
+        # Without a saved item table, rows start out as Song ids like the weights trained before it.
+        assert snapshot.index == {"c1": s1.id, "c2": s2.id}
+        assert catalog.get() is snapshot
+
+        s1.delete()
+        s3 = make_song("c3")
+        snapshot = catalog.get()
+        assert snapshot.index == {"c2": s2.id, "c3": s2.id + 1}
+        assert snapshot.track_ids[snapshot.item_ids == s2.id].tolist() == ["c2"]
+        assert snapshot.song_ids.tolist() == [s2.id, s3.id]
+
+    def test_version_bumps_from_other_processes_are_seen(self, item_index):
+        from django.core.cache.backends.db import DatabaseCache
+
+        make_song("v1")
+        snapshot = catalog.get()
+        # Another process (e.g. import_songs) only shares the version stamp with this one.
+        CatalogIndex(path=item_index).invalidate()
+        assert isinstance(shared_cache(), DatabaseCache)
+        assert catalog.get() is not snapshot
+
+    def test_item_rows_are_stable_across_reimports(self, item_index):
+        save_item_table(np.array(["r1", "r2"]), item_index)
+        make_song("r1")
+        s2 = make_song("r2")
+        catalog.get()
+
+        s2.delete()
+        make_song("r3")
+        make_song("r2")
+        snapshot = catalog.get()
+        assert snapshot.index == {"r1": 1, "r3": 3, "r2": 2}
+        assert snapshot.item_table.tolist() == ["r1", "r2", "r3"]
+
+        r4 = make_song("r4")
+        catalog.get()
+        r4.delete()
+        make_song("r5")
+        assert catalog.get().index["r5"] == 5
+
+
+class TestMicroBatcher:
+    def test_concurrent_requests_are_coalesced(self):
+        calls = []
+
+        def handler(requests):
+            calls.append(list(requests))
+            return [r * 2 for r in requests]
+
+        batcher = MicroBatcher(handler, window_ms=50, max_batch=8)
+        results = {}
+        threads = [
+            threading.Thread(target=lambda n=n: results.__setitem__(n, batcher.submit(n)))
+            for n in range(4)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert results == {0: 0, 1: 2, 2: 4, 3: 6}
+        assert len(calls) < 4
+
+
+class TestTagFeatures:
+    def test_artifact_is_reused_until_catalog_changes(self, tmp_path):
+        make_song("f1", tags="rock, sad")
+        s2 = make_song("f2", tags="Pop")
+        built = get_tag_features(path=str(tmp_path))
+        assert built.vocabulary == ["pop", "rock", "sad"]
+
+        loaded = get_tag_features(path=str(tmp_path))
+        assert loaded.catalog_hash == built.catalog_hash
+        assert isinstance(loaded.item_ids, np.memmap)
+        assert not loaded.matrix.data.flags.owndata
+        assert np.allclose(loaded.matrix.toarray(), built.matrix.toarray())
+
+        s2.tags = "jazz"
+        s2.save()
+        rebuilt = get_tag_features(path=str(tmp_path))
+        assert rebuilt.catalog_hash != built.catalog_hash
+        assert "jazz" in rebuilt.vocabulary
+
+
+    def test_rebuild_keeps_the_replaced_artifact_for_open_readers(self, tmp_path):
+        import os
+
+        song = make_song("g1", tags="rock")
+        first = get_tag_features(path=str(tmp_path)).catalog_hash[:16]
+        song.tags = "pop"
+        song.save()
+        second = get_tag_features(path=str(tmp_path)).catalog_hash[:16]
+        song.tags = "jazz"
+        song.save()
+        third = get_tag_features(path=str(tmp_path)).catalog_hash[:16]
+
+        prefixes = {name.split(".")[0] for name in os.listdir(tmp_path) if name.endswith(".npy")}
+        assert prefixes == {second, third} and first not in prefixes
+        assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+    def test_item_tag_matrix_follows_item_rows(self, tmp_path):
+        s1 = make_song("t1", tags="rock")
+        s2 = make_song("t2", tags="pop")
+        features = get_tag_features(path=str(tmp_path))
+        matrix = item_tag_matrix(features, [s2.id, s1.id, 999], [1, 3, 4], 4).toarray()
+
+        dense = features.matrix.toarray()
+        assert np.array_equal(matrix, np.stack([dense[1], np.zeros(2), dense[0], np.zeros(2)]))
+
+
+def make_model(item_num=20, vocab=6):
+    args = _types.SimpleNamespace(
+        hidden_units=8, num_heads=2, num_blocks=2, dropout_rate=0.0, maxlen=10, device="cpu"
+    )
+    torch.manual_seed(0)
+    return SASRec(user_num=1, item_num=item_num, args=args, tag_feature_tensor=torch.rand(item_num, vocab)).eval()
+
+
+def make_recommender(model=None, maxlen=10, item_tags=None):
+    """SASRecRecommender serving a small in-memory model, built like any other instance."""
+    args = _types.SimpleNamespace(maxlen=maxlen, device="cpu")
+    return SASRecRecommender.from_model(model or make_model(), args, item_tags)
+
+
+class TestSASRecPredict:
+    def test_feedback_boost_matches_per_event_adjustment(self):
+        model = make_model()
+        items = torch.arange(1, 21).unsqueeze(0)
+        log_seqs = torch.tensor([[0, 3, 4, 5], [1, 2, 3, 4]])
+        pos = torch.tensor([[3, 3, 0], [7, 0, 0]])
+        neg = torch.tensor([[9], [0]])
+
+        with torch.no_grad():
+            base = model.predict(None, log_seqs, items)
+            boosted = model.predict(None, log_seqs, items, pos, neg, pos_weight=2.0, neg_weight=0.5)
+
+        expected = base.clone()
+        expected[0, 2] += 4.0
+        expected[0, 8] -= 0.5
+        expected[1, 6] += 2.0
+        assert torch.allclose(boosted, expected)
+
+    def test_sparse_tag_projection_matches_dense(self):
+        torch.manual_seed(0)
+        dense = torch.rand(20, 6) * (torch.rand(20, 6) > 0.5)
+        dense[4] = 0.0
+        args = _types.SimpleNamespace(
+            hidden_units=8, num_heads=2, num_blocks=1, dropout_rate=0.0, maxlen=10, device="cpu"
+        )
+        model = SASRec(user_num=1, item_num=20, args=args, tag_feature_tensor=dense)
+        ids = torch.tensor([[0, 1, 5, 20], [3, 3, 0, 7]])
+
+        padded = torch.cat([torch.zeros(1, 6), dense])
+        assert torch.allclose(model.project_tags(ids), model.feature_proj(padded[ids]), atol=1e-6)
+        assert torch.equal(model.tag_vectors(ids[1]), padded[ids[1]])
+
+    def test_cached_item_table_matches_live_encoding(self):
+        model = make_model()
+        log_seqs = torch.tensor([[0, 3, 4, 5], [1, 2, 3, 4]])
+        with torch.no_grad():
+            cached = model.predict(None, log_seqs)
+            assert model._fused_items is not None
+        with torch.enable_grad():
+            live = model.predict(None, log_seqs).detach()
+        assert torch.allclose(cached, live, atol=1e-6)
+
+        state = {k: v + 1.0 if k == "item_emb.weight" else v for k, v in model.state_dict().items()}
+        model.load_state_dict(state)
+        assert model._fused_items is None
+
+
+    def test_forward_returns_the_features_behind_its_logits(self):
+        model = make_model()
+        log_seqs = torch.tensor([[0, 3, 4, 5], [1, 2, 3, 4]])
+        pos = torch.tensor([[3, 4, 5, 6], [2, 3, 4, 5]])
+        neg = torch.tensor([[9, 9, 9, 9], [8, 8, 8, 8]])
+        with torch.no_grad():
+            pos_logits, neg_logits, feats = model(None, log_seqs, pos, neg, return_feats=True)
+            assert torch.allclose(feats, model.log2feats(log_seqs), atol=1e-6)
+        assert torch.allclose(pos_logits, (feats * model.item_emb(pos)).sum(-1))
+        assert torch.allclose(neg_logits, (feats * model.item_emb(neg)).sum(-1))
+
+    def test_grown_model_keeps_saved_rows_and_tag_columns(self):
+        old = make_model(item_num=20, vocab=6)
+        with torch.no_grad():
+            old.item_emb.weight.add_(1.0)
+            old.feature_proj.weight.add_(1.0)
+        new = make_model(item_num=25, vocab=7)
+        fresh = new.item_emb.weight.detach().clone()
+        # New vocabulary: saved tags 0..5 reordered, plus one new tag.
+        columns = [5, 4, 3, 2, 1, 0, -1]
+
+        assert new.load_grown_state_dict(old.state_dict(), columns) == 5
+        assert torch.equal(new.item_emb.weight[:21], old.item_emb.weight)
+        assert torch.equal(new.item_emb.weight[21:], fresh[21:])
+        assert torch.equal(new.feature_proj.weight[:, :6], old.feature_proj.weight.flip(1))
+        assert torch.equal(new.attention_layers[0].in_proj_weight, old.attention_layers[0].in_proj_weight)
+
+    def test_incremental_encoding_matches_full_pass(self, settings):
+        settings.RECOMMENDER_STATE_CACHE_USERS = 4
+        recommender = make_recommender()
+
+        def full(sequence):
+            return recommender.model.log2feats(torch.tensor([sequence]))[0, -1]
+
+        with torch.no_grad():
+            recommender.encode([UserHistory(1, [3, 4], [], []), UserHistory(2, [5, 6, 7], [], [])])
+            # Cached states own their tensors instead of viewing the batch's.
+            state = recommender._states[1]
+            assert all(t._base is None for t in state.keys + state.values + [state.feat])
+            grown = [UserHistory(1, [3, 4, 8, 9], [], []), UserHistory(2, [6, 7, 1], [], [])]
+            feats = recommender.encode(grown)
+            assert recommender._states[1].sequence == (3, 4, 8, 9)
+            for row, history in enumerate(grown):
+                assert torch.allclose(feats[row], full(history.sequence), atol=1e-5)
+
+
+class TestRetrieval:
+    def test_exact_retriever_applies_boost(self):
+        vectors = torch.eye(4)
+        queries = torch.tensor([[1.0, 0.5, 0.0, 0.0]])
+        assert ExactRetriever(vectors).search(queries, 2).tolist() == [[0, 1]]
+        feedback = (torch.tensor([[3, 0]]), torch.tensor([[2.0, 0.0]]))
+        assert ExactRetriever(vectors).search(queries, 2, feedback).tolist() == [[3, 0]]
+
+    def test_ivf_probing_every_list_is_exact(self):
+        torch.manual_seed(0)
+        vectors = torch.randn(200, 8)
+        queries = torch.randn(5, 8)
+        ivf = IVFRetriever(vectors, n_lists=10, n_probe=10)
+        expected = ExactRetriever(vectors).search(queries, 10)
+        assert torch.equal(ivf.search(queries, 10).sort(dim=1).values, expected.sort(dim=1).values)
+
+    def test_ivf_applies_sparse_feedback_outside_probed_lists(self):
+        torch.manual_seed(0)
+        vectors = torch.randn(200, 8)
+        queries = torch.randn(3, 8)
+        ivf = IVFRetriever(vectors, n_lists=10, n_probe=1)
+        # Position 5 is boosted twice (weights accumulate); the 0-weight entry is padding.
+        feedback = (torch.tensor([[5, 5, 0]] * 3), torch.tensor([[50.0, 50.0, 0.0]] * 3))
+        results = ivf.search(queries, 4, feedback)
+        assert results[:, 0].tolist() == [5, 5, 5]
+
+        exact = ExactRetriever(vectors).search(queries, 4, feedback)
+        full = IVFRetriever(vectors, n_lists=10, n_probe=10).search(queries, 4, feedback)
+        assert torch.equal(full, exact)
+
+
+class TestActivitySpool:
+    def test_failed_flush_keeps_events(self, tmp_path, monkeypatch):
+        user = User.objects.create(username="spooler")
+        spool = ActivitySpool(str(tmp_path / "spool.sqlite3"))
+        spool.append(user.id, [("s1", "play")])
+
+        def broken_bulk_create(objs, *args, **kwargs):
+            raise RuntimeError("database unavailable")
+
+        monkeypatch.setattr(UserActivity.objects, "bulk_create", broken_bulk_create)
+        with pytest.raises(RuntimeError):
+            spool.flush()
+        assert spool.pending() == 1
+
+        monkeypatch.undo()
+        assert spool.flush() == 1
+        activity = UserActivity.objects.get(user=user)
+        assert activity.track_id == "s1"
+        assert spool.pending() == 0
+
+
+    def test_concurrent_flushers_insert_each_event_once(self, tmp_path, monkeypatch):
+        user = User.objects.create(username="spooled-twice")
+        path = str(tmp_path / "spool.sqlite3")
+        spool, other_process = ActivitySpool(path), ActivitySpool(path)
+        spool.append(user.id, [("s1", "play"), ("s2", "like")])
+
+        bulk_create = UserActivity.objects.bulk_create
+        flushed_meanwhile = []
+
+        def racing_bulk_create(objs, *args, **kwargs):
+            # The other flusher runs while this batch is being inserted.
+            flushed_meanwhile.append(other_process.flush())
+            return bulk_create(objs, *args, **kwargs)
+
+        monkeypatch.setattr(UserActivity.objects, "bulk_create", racing_bulk_create)
+        assert spool.flush() == 2
+        assert flushed_meanwhile == [0]
+        assert UserActivity.objects.filter(user=user).count() == 2
+        assert spool.pending() == 0
+
+
+    def test_boot_starts_the_flusher_of_an_existing_spool(self, settings, tmp_path, monkeypatch):
+        settings.RECOMMENDER_ACTIVITY_SPOOL = str(tmp_path / "spool.sqlite3")
+        spool = get_spool(start=False)
+        monkeypatch.setattr(spool, "_run", lambda: spool._stop.wait())
+        assert get_spool() is spool
+        assert spool._flusher.is_alive()
+        spool.stop()
+
+    def test_flush_invalidates_cached_results_of_flushed_users(self, tmp_path):
+        user = User.objects.create(username="flushed")
+        before = activity_stamp(user.id)
+        history_cache.put(user.id, 0, before, UserHistory(user.id, [1], [], []))
+        spool = ActivitySpool(str(tmp_path / "spool.sqlite3"))
+        spool.append(user.id, [("s1", "play")])
+
+        assert spool.flush() == 1
+        assert activity_stamp(user.id) != before
+        assert history_cache.get(user.id, 0, before) is None
+
+
+class TestActivityQueryBenchmark:
+    def test_seeded_rows_are_rolled_back(self):
+        import io
+        from django.core.management import call_command
+
+        out = io.StringIO()
+        call_command("benchmark_activity_queries", rows=50, users=3, tracks=5, repeat=2, chunk=20, stdout=out)
+        assert "Rolled back the seeded rows" in out.getvalue()
+        assert not UserActivity.objects.exists()
+        assert not User.objects.filter(username__startswith="bench_user_").exists()
+
+
+class TestUserHistory:
+    def test_history_is_bounded_and_chronological(self, django_assert_num_queries):
+        user = User.objects.create(username="heavy")
+        songs = [make_song(f"h{i}") for i in range(6)]
+        start = timezone.now()
+        UserActivity.objects.bulk_create([
+            UserActivity(user=user, track_id=song.track_id, activity_type=activity_type,
+                         timestamp=start + timedelta(seconds=i))
+            for i, (song, activity_type) in enumerate(zip(
+                songs, ["play", "like", "skip", "play", "play", "unlike"]
+            ))
+        ])
+
+        recommender = make_recommender(maxlen=3)
+        snapshot = catalog.get()
+
+        with django_assert_num_queries(2):
+            history = recommender.user_history(user.id, snapshot)
+        row = [snapshot.index[song.track_id] for song in songs]
+        assert history.sequence == [row[1], row[3], row[4]]
+        assert sorted(zip(history.feedback, history.weights)) == [
+            (row[1], 1.0), (row[2], -1.0), (row[5], -1.0)
+        ]
+
+    def test_cached_history_tracks_new_activity(self):
+        user = User.objects.create(username="cached")
+        for i in range(5):
+            make_song(f"c{i}")
+        recommender = make_recommender(maxlen=3)
+        cache = SequenceCache(maxlen=3)
+
+        def log(*events):
+            UserActivity.objects.bulk_create([
+                UserActivity(user=user, track_id=track_id, activity_type=activity_type)
+                for track_id, activity_type in events
+            ])
+            previous = activity_stamp(user.id)
+            cache.append(user.id, events, previous, touch_activity(user.id))
+
+        log(("c0", "play"), ("c1", "like"))
+        snapshot = catalog.get()
+        cache.put(user.id, snapshot.version, activity_stamp(user.id), recommender.user_history(user.id, snapshot))
+        log(("c2", "play"), ("c3", "skip"), ("missing", "skip"), ("c4", "addPlaylist"))
+
+        stamp = activity_stamp(user.id)
+        assert cache.get(user.id, snapshot.version, stamp) == recommender.user_history(user.id, snapshot)
+        assert cache.get(user.id, snapshot.version + 1, stamp) is None
+
+        # Activity logged by another process changes the stamp without reaching this entry.
+        touch_activity(user.id)
+        assert cache.get(user.id, snapshot.version, activity_stamp(user.id)) is None
+        log(("c0", "play"))
+        assert cache.get(user.id, snapshot.version, activity_stamp(user.id)) is None
+
+    def test_local_cache_evicts_least_recently_used(self):
+        cache = SequenceCache(max_bytes=1)
+        cache.put(1, 0, 0, UserHistory(1, [1], [], []))
+        cache.put(2, 0, 0, UserHistory(2, [2], [], []))
+        assert cache.get(1, 0, 0) is None
+        assert cache.get(2, 0, 0).sequence == [2]
+
+
+class TestResultCache:
+    def test_new_activity_or_model_misses(self):
+        results = ResultCache()
+        key = results.key(7, "model-a", 0)
+        assert results.get(key) is None
+        results.set(key, ["x1", "x2"])
+        assert results.get(results.key(7, "model-a", 0)) == ["x1", "x2"]
+        assert results.get(results.key(7, "model-b", 0)) is None
+
+        touch_activity(7)
+        assert results.get(results.key(7, "model-a", 0)) is None
+        assert results.stats() == {"hits": 1, "misses": 3, "hit_rate": 0.25}
+
+    def test_activity_stamps_live_in_the_shared_cache(self):
+        from django.core.cache.backends.db import DatabaseCache
+
+        assert isinstance(stamp_cache(), DatabaseCache)
+        before = activity_stamp(8)
+        touch_activity(8)
+        assert stamp_cache().get("recommender:activity:8") == activity_stamp(8) != before
+
+
+class TestTrainingSamples:
+    def test_samples_match_prefix_construction(self):
+        users = np.array([1, 1, 1, 1, 1, 2, 2, 3, 3, 3])
+        items = np.array([5, 6, 7, 8, 9, 4, 5, 1, 2, 3])
+        train, valid = build_training_samples(users, items, np.arange(1, 10), seed=0)
+
+        maxlen = 2
+        prefixes = [
+            (u, train.items[max(s, e - maxlen):e].tolist(), p)
+            for u, s, e, p in zip(train.users, train.starts, train.ends, train.positives)
+        ]
+        assert prefixes == [
+            (1, [5], 6), (1, [5, 6], 7), (1, [6, 7], 8),
+            (3, [1], 2),
+        ]
+        assert not np.any(train.negatives == train.positives)
+        assert valid.users.tolist() == [1, 2, 3]
+        assert valid.targets.tolist() == [9, 5, 3]
+
+    def test_sequence_windows_cover_every_target_once(self):
+        users = np.array([1, 1, 1, 1, 1, 2, 2, 3, 3, 3])
+        items = np.array([5, 6, 7, 8, 9, 4, 5, 1, 2, 3])
+        train, _ = build_training_samples(users, items, np.arange(1, 10), seed=0)
+        windows = build_sequence_samples(train, maxlen=2)
+
+        assert windows.users.tolist() == [1, 1, 3]
+        assert windows.inputs.tolist() == [[6, 7], [0, 5], [0, 1]]
+        assert windows.positives.tolist() == [[7, 8], [0, 6], [0, 2]]
+        pairs = sorted(zip(windows.positives[windows.positives > 0], windows.negatives[windows.positives > 0]))
+        assert pairs == sorted(zip(train.positives, train.negatives))
+
+    def test_dataset_returns_padded_batches(self):
+        users = np.array([1, 1, 1, 1, 1, 3, 3, 3])
+        items = np.array([5, 6, 7, 8, 9, 1, 2, 3])
+        train, _ = build_training_samples(users, items, np.arange(1, 10), seed=0)
+        uids, log_seqs, pos, neg = SasrecDataset(train, maxlen=2)[[3, 0, 2]]
+
+        assert uids.tolist() == [3, 1, 1]
+        assert log_seqs.tolist() == [[0, 1], [0, 5], [6, 7]]
+        assert pos.tolist() == [[2], [6], [8]]
+        assert neg.shape == (3, 1)
+
+
+class TestEvalMetrics:
+    def test_sparse_tag_metrics_match_pairwise_cosines(self):
+        import scipy.sparse as sp
+        from sklearn.preprocessing import normalize
+
+        rng = np.random.default_rng(0)
+        dense = rng.random((12, 5)) * (rng.random((12, 5)) > 0.4)
+        dense[3] = 0.0
+        tags = normalize(sp.csr_matrix(dense), norm="l2")
+        unit = tags.toarray()
+        top = np.array([[0, 3, 7, 2], [5, 6, 1, 11]])
+
+        expected = [
+            np.mean([unit[i] @ unit[j] for a, i in enumerate(row) for j in row[a + 1:]]) for row in top
+        ]
+        assert np.allclose(intra_list_similarity(top, tags), expected)
+
+        similar, sims = tag_neighbours(np.array([0, 5]), tags, 3)
+        for target, row, values in zip([0, 5], similar, sims):
+            scores = unit @ unit[target]
+            scores[target] = -np.inf
+            assert sorted(values.tolist()) == pytest.approx(sorted(np.sort(scores)[-3:].tolist()))
+            assert target not in row
+
+    def test_feedback_stops_before_the_held_out_target(self):
+        import pandas as pd
+
+        events = pd.DataFrame({
+            "user_id": [1, 1, 1, 1, 2, 2],
+            "item": [3, 4, 4, 5, 6, 7],
+            "activity_type": ["like", "skip", "play", "addPlaylist", "play", "like"],
+        }).assign(position=np.arange(6))
+        # User 1's target is the play at position 2; user 2's is their last event.
+        positives, negatives = feedback_before(events, pd.Series({1: 2, 2: 5}))
+        assert positives.to_dict() == {1: [3]}
+        assert negatives.to_dict() == {1: [4]}
+
+    def test_personalization_matches_pairwise_jaccard(self):
+        rng = np.random.default_rng(1)
+        top = np.stack([rng.choice(15, 4, replace=False) for _ in range(9)])
+        sets = [set(row) for row in top.tolist()]
+        overlaps = [
+            len(a & b) / len(a | b) for i, a in enumerate(sets) for b in sets[i + 1:]
+        ]
+
+        score, half_width = personalization_score(top, 15, block_size=2)
+        assert score == pytest.approx(1 - np.mean(overlaps))
+        assert half_width == 0.0
+
+        estimate, half_width = personalization_score(top, 15, sample=5, seed=0)
+        assert 0.0 <= estimate <= 1.0 and half_width > 0.0
+
+
+class TestRankingMetrics:
+    def test_ranks_match_double_argsort(self):
+        torch.manual_seed(0)
+        scores = torch.rand(4, 30)
+        columns = torch.tensor([0, 7, 29, 12])
+        expected = (-scores).argsort(dim=1).argsort(dim=1).gather(1, columns[:, None]).squeeze(1)
+        assert torch.equal(target_ranks(scores, columns), expected)
+
+    def test_sampled_candidates_avoid_seen_items(self):
+        rng = np.random.default_rng(0)
+        candidates = sample_candidates(np.array([3, 5]), np.arange(1, 9), 20, [{1, 2}, {6, 7, 8}], rng)
+        assert candidates[:, 0].tolist() == [3, 5]
+        assert not np.isin(candidates[0, 1:], [1, 2, 3]).any()
+        assert not np.isin(candidates[1, 1:], [5, 6, 7, 8]).any()
+
+    def test_sampled_ranks_reuse_full_scores(self):
+        scores = torch.tensor([[0.1, 0.9, 0.5, 0.3, 0.7], [0.8, 0.2, 0.6, 0.4, 0.0]])
+        ranks = sampled_ranks(scores, np.array([2, 2]), 2, [{1}, {0, 3}], np.random.default_rng(0))
+        # Row 0 samples from columns {0, 3, 4}; row 1 can only draw columns 1 and 4.
+        assert ranks[1].item() == 0
+        assert 0 <= ranks[0].item() <= 2
+
+    def test_full_catalog_metrics(self):
+        model = make_model()
+        sequences = [[1, 2, 3], [4, 5], [6]]
+        targets = [4, 9, 2]
+        with torch.no_grad():
+            scores = model.predict(None, torch.tensor([[1, 2, 3], [0, 4, 5], [0, 0, 6]]), torch.arange(1, 21)[None])
+        ranks = (scores > scores.gather(1, torch.tensor(targets)[:, None] - 1)).sum(1).numpy()
+
+        metrics = evaluate_ranking(model, sequences, targets, np.arange(1, 21), maxlen=10, k=5, batch_size=2)
+        assert metrics.users == 3
+        assert metrics.hr == pytest.approx(np.mean(ranks < 5))
+        assert metrics.ndcg == pytest.approx(np.mean((ranks < 5) / np.log2(ranks + 2)))
+        assert metrics.mrr == pytest.approx(np.mean(1 / (ranks + 1)))
+
+
+class TestEvalCommand:
+    def test_eval_runs_on_a_small_catalog(self, monkeypatch, item_index):
+        import io
+        import scipy.sparse as sp
+        from django.core.management import call_command
+        import recommender.management.commands.eval as eval_command
+
+        save_item_table(np.array([f"e{i}" for i in range(6)]), item_index)
+        user = User.objects.create(username="evaluated")
+        songs = [make_song(f"e{i}", tags="rock" if i % 2 else "pop") for i in range(6)]
+        start = timezone.now()
+        UserActivity.objects.bulk_create([
+            UserActivity(user=user, track_id=song.track_id, activity_type=activity_type,
+                         timestamp=start + timedelta(seconds=i))
+            for i, (song, activity_type) in enumerate(zip(
+                songs, ["play", "like", "play", "skip", "play", "addPlaylist"]
+            ))
+        ])
+
+        recommender = make_recommender(
+            make_model(item_num=6, vocab=2), item_tags=sp.csr_matrix(np.random.default_rng(0).random((6, 2)))
+        )
+        monkeypatch.setattr(eval_command, "lazy_sasrec", _types.SimpleNamespace(get=lambda block=False: recommender))
+
+        out = io.StringIO()
+        call_command("eval", k=3, n=2, stdout=out)
+        output = out.getvalue()
+        assert "Evaluating SASRec model on 1 users" in output
+        assert "HR@3" in output and "Diversity" in output
+
+        out = io.StringIO()
+        call_command("eval", k=3, n=2, ranking="sampled", negatives=2, seed=0, stdout=out)
+        assert "(sampled)" in out.getvalue()
@@ -1,7 +1,8 @@
 from django.urls import path
-from .views import UserActivityView, RecommendedSongsView
+from .views import UserActivityView, RecommendedSongsView, RecommenderStatusView
 
 urlpatterns = [
     path("useractivity/", UserActivityView.as_view(), name="useractivity"),
     path("recommend/", RecommendedSongsView.as_view(), name="recommend"),
+    path("status/", RecommenderStatusView.as_view(), name="recommender_status"),
 ]
\ No newline at end of file
@@ -1,3 +1,6 @@
+import logging
+from django.conf import settings
+from django.db import transaction
 from django.shortcuts import render
 from rest_framework.views import APIView
 from rest_framework.permissions import AllowAny, IsAuthenticated
@@ -5,13 +8,32 @@ from rest_framework.response import Response
 from rest_framework import status
 from .models import UserActivity, Song
 from .services import sasrec
+from .exceptions import RecommenderNotReady
+from .spool import get_spool
+from .history import history_cache
+from .results import activity_stamp, result_cache, touch_activity
 from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from songs.serializers import SongSerializer
 import json
 
+logger = logging.getLogger(__name__)
+
 class UserActivityView(APIView):
     permission_classes = [IsAuthenticated]
+    activity_types = {choice for choice, _ in UserActivity.ACTIVITY_TYPES}
+
+    def validate_event(self, event):
+        if not isinstance(event, dict):
+            return "Event must be an object"
+        if event.get("type") not in self.activity_types:
+            return f"Unknown activity type: {event.get('type')!r}"
+        track_id = event.get("songId")
+        if track_id is not None and not isinstance(track_id, str):
+            return "songId must be a string"
+        if track_id is not None and len(track_id) > UserActivity._meta.get_field("track_id").max_length:
+            return "songId is too long"
+        return None
 
     def post(self, request):
         try:
@@ -21,19 +43,60 @@ class UserActivityView(APIView):
             if not activity_logs:
                 return Response({"error": "Missing activity_logs"}, status=status.HTTP_400_BAD_REQUEST)
 
-            user = request.user
+            if not isinstance(activity_logs, list):
+                return Response({"error": "activity_logs must be a list"}, status=status.HTTP_400_BAD_REQUEST)
 
-            for event in activity_logs:
-                track_id = event.get("songId")
-                activity_type = event["type"]
+            max_batch = getattr(settings, "RECOMMENDER_ACTIVITY_MAX_BATCH", 500)
+            if len(activity_logs) > max_batch:
+                return Response(
+                    {"error": f"Too many events: at most {max_batch} per request"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
 
-                UserActivity.objects.create(
+            user = request.user
+            activities, rejected = [], []
+            for index, event in enumerate(activity_logs):
+                error = self.validate_event(event)
+                if error:
+                    rejected.append({"index": index, "error": error})
+                    continue
+                activities.append(UserActivity(
                     user=user,
-                    track_id=track_id,
-                    activity_type=activity_type
+                    track_id=event.get("songId"),
+                    activity_type=event["type"]
+                ))
+
+            if not activities:
+                return Response(
+                    {"error": "No valid events", "rejected": rejected},
+                    status=status.HTTP_400_BAD_REQUEST,
                 )
 
-            return Response({"message": "Activity logged successfully"}, status=status.HTTP_201_CREATED)
+            body = {"message": "Activity logged successfully"}
+            if rejected:
+                body["rejected"] = rejected
+
+            spool = get_spool()
+            if spool is not None:
+                # Write-behind: the background flusher inserts the events.
+                spool.append(user.id, [(a.track_id, a.activity_type) for a in activities])
+                response_status = status.HTTP_202_ACCEPTED
+            else:
+                with transaction.atomic():
+                    UserActivity.objects.bulk_create(activities)
+                response_status = status.HTTP_201_CREATED
+
+            try:
+                previous_stamp = activity_stamp(user.id)
+                stamp = touch_activity(user.id)
+                history_cache.append(
+                    user.id, [(a.track_id, a.activity_type) for a in activities], previous_stamp, stamp
+                )
+            except Exception:
+                # The events are already stored or spooled (the flusher touches the stamp
+                # again); failing the request now would only make clients log them twice.
+                logger.exception("Failed to update the recommender caches for user %s", user.id)
+            return Response(body, status=response_status)
 
         except json.JSONDecodeError:
             return Response({"error": "Invalid JSON"}, status=status.HTTP_400_BAD_REQUEST)
@@ -45,7 +108,14 @@ class RecommendedSongsView(APIView):
     def get(self, request):
         user_id = request.user.id
 
-        rec_track_ids = sasrec.recommend(user_id)
+        try:
+            rec_track_ids = sasrec.recommend(user_id)
+        except RecommenderNotReady:
+            return Response(
+                {"error": "Recommender is warming up"},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": "5"},
+            )
 
         if not rec_track_ids:
             return Response({"recommendations": []})
@@ -55,3 +125,13 @@ class RecommendedSongsView(APIView):
         serializer = SongSerializer(songs_in_order, many=True)
         return Response({"recommendations": serializer.data})
 
+
+class RecommenderStatusView(APIView):
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        return Response({
+            "ready": sasrec.ready,
+            "load_seconds": sasrec.load_seconds,
+            "result_cache": result_cache.stats(),
+        })
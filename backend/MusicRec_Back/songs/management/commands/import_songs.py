@@ -1,6 +1,7 @@
 import csv
 from django.core.management.base import BaseCommand
 from songs.models import Song
+from recommender.catalog import catalog
 
 class Command(BaseCommand):
     help = "Import songs from a CSV file into the database"
@@ -47,4 +48,6 @@ class Command(BaseCommand):
                 songs_to_create.append(song)
 
             Song.objects.bulk_create(songs_to_create)
+            # bulk_create skips model signals, so bump the catalog version explicitly.
+            catalog.invalidate()
             self.stdout.write(self.style.SUCCESS(f"Successfully imported {len(songs_to_create)} songs!"))